@@ -0,0 +1,31 @@
+import io
+from typing import Dict
+
+from PIL import Image, ImageOps
+
+AVATAR_SIZES = (48, 128, 512)
+AVATAR_FORMATS = {
+    "webp": ("WEBP", "image/webp"),
+    "jpg": ("JPEG", "image/jpeg"),
+}
+MAX_AVATAR_PIXELS = 40_000_000
+
+
+def render_thumbnails(data: bytes) -> Dict[str, bytes]:
+    """Decode an uploaded image and return square thumbnails keyed by file name.
+
+    Runs inside a worker process, so it only takes and returns plain bytes.
+    """
+    Image.MAX_IMAGE_PIXELS = MAX_AVATAR_PIXELS
+    with Image.open(io.BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source)
+        image = image.convert("RGB")
+
+    thumbnails = {}
+    for size in AVATAR_SIZES:
+        thumb = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        for extension, (pil_format, _) in AVATAR_FORMATS.items():
+            buffer = io.BytesIO()
+            thumb.save(buffer, format=pil_format, quality=85)
+            thumbnails[f"{size}.{extension}"] = buffer.getvalue()
+    return thumbnails
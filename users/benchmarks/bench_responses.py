@@ -0,0 +1,100 @@
+"""Compare wire size and CPU cost of serializing a large room history.
+
+Run from the users directory:
+
+    python benchmarks/bench_responses.py --messages 5000 --iterations 20
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from compression import compress
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua room chat message"
+).split()
+
+
+def build_history(count: int, image_every: int, seed: int = 7):
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    senders = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(25)]
+    messages = []
+    for index in range(count):
+        content = {
+            "uuid": str(uuid.UUID(int=rng.getrandbits(128))),
+            "text": " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 40))),
+        }
+        if image_every and index % image_every == 0:
+            content["attachments"] = [{
+                "mimeType": "image/jpeg",
+                "data": base64.b64encode(rng.randbytes(24 * 1024)).decode(),
+            }]
+        messages.append({
+            "content": json.dumps(content),
+            "sender": rng.choice(senders),
+            "timestamp": (start + timedelta(seconds=index * 13)).isoformat(),
+            "roomId": "benchmark-room",
+            "content_uuid": content["uuid"],
+        })
+    return {"messages": messages}
+
+
+def measure(label, render, iterations, encoding=None, gzip_level=6, brotli_quality=5):
+    body = b""
+    started = time.process_time()
+    for _ in range(iterations):
+        body = render()
+        if encoding:
+            body = compress(body, encoding, gzip_level, brotli_quality)
+    elapsed = (time.process_time() - started) / iterations
+    return label, len(body), elapsed * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--image-every", type=int, default=50,
+                        help="embed a base64 image in every Nth message (0 disables)")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--gzip-level", type=int, default=6)
+    parser.add_argument("--brotli-quality", type=int, default=5)
+    args = parser.parse_args()
+
+    history = build_history(args.messages, args.image_every)
+
+    def baseline():
+        return JSONResponse(jsonable_encoder(history)).body
+
+    def fast():
+        return ORJSONResponse(history).body
+
+    rows = [
+        measure("stdlib json (before)", baseline, args.iterations),
+        measure("orjson", fast, args.iterations),
+        measure("orjson + gzip", fast, args.iterations, "gzip",
+                args.gzip_level, args.brotli_quality),
+        measure("orjson + br", fast, args.iterations, "br",
+                args.gzip_level, args.brotli_quality),
+    ]
+
+    print(f"{args.messages} messages, image every {args.image_every}, "
+          f"{args.iterations} iterations")
+    print(f"{'variant':<24}{'bytes on wire':>16}{'cpu ms/response':>18}")
+    for label, size, cpu_ms in rows:
+        print(f"{label:<24}{size:>16,}{cpu_ms:>18.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Compare message write throughput with and without the write-behind buffer.
+
+Runs the same Redis writes post_message makes (LPUSH, PUBLISH, activity
+script, replay stream entry) from many concurrent senders against a real
+Redis, first one pipeline per message, then through the buffer. Run from the
+users directory against a scratch Redis:
+
+    python benchmarks/bench_write_behind.py --redis-url redis://localhost:6379/15 --messages 20000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+import redis
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from metrics import Metrics
+from repository import (
+    Repository,
+    get_messages_key,
+    get_room_events_key,
+    get_room_summary_key,
+    get_users_key,
+)
+from room_scripts import RoomScripts
+from write_behind import WriteBehindBuffer
+
+
+def build_writer(repo: Repository, scripts: RoomScripts, room_id: str, sender: str):
+    message_id = str(uuid.uuid4())
+    timestamp = datetime.now(timezone.utc)
+    message = {
+        "content": json.dumps({"uuid": message_id, "text": "benchmark message"}),
+        "sender": sender,
+        "timestamp": timestamp.isoformat(),
+        "roomId": room_id,
+        "content_uuid": message_id,
+    }
+    message_json = json.dumps(message)
+
+    def write():
+        repo.messages.push(room_id, message)
+        repo.messages.publish(room_id, message_json)
+        repo.run_script(
+            scripts.record_activity,
+            keys=[get_room_summary_key(room_id)],
+            args=[room_id, timestamp.timestamp(), sender, message_id,
+                  "message_id", message_id, "sender", sender],
+        )
+        return repo.messages.append_event(room_id, message, 1000)
+
+    return write
+
+
+async def run(repo: Repository, scripts: RoomScripts, args, window: float) -> float:
+    buffer = WriteBehindBuffer(repo, repo.metrics, window=window, max_batch=args.batch)
+    queue: asyncio.Queue = asyncio.Queue()
+    for index in range(args.messages):
+        queue.put_nowait(index)
+
+    async def sender(number: int):
+        sender_id = f"bench-user-{number}"
+        while not queue.empty():
+            index = queue.get_nowait()
+            room_id = f"bench-room-{index % args.rooms}"
+            await buffer.submit(build_writer(repo, scripts, room_id, sender_id))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender(number) for number in range(args.concurrency)))
+    return args.messages / (time.perf_counter() - started)
+
+
+def reset(client: redis.Redis, args):
+    for number in range(args.rooms):
+        room_id = f"bench-room-{number}"
+        client.delete(
+            get_messages_key(room_id),
+            get_room_events_key(room_id),
+            get_room_summary_key(room_id),
+        )
+        client.sadd(get_users_key(room_id), *(f"bench-user-{n}" for n in range(args.members)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--redis-url", default="redis://localhost:6379/15")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--members", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=200,
+                        help="concurrent senders")
+    parser.add_argument("--window-ms", type=float, default=2.0)
+    parser.add_argument("--batch", type=int, default=100)
+    args = parser.parse_args()
+
+    client = redis.Redis.from_url(args.redis_url)
+    repo = Repository(client, Metrics())
+    scripts = RoomScripts(client)
+
+    rows = []
+    for label, window in (("one pipeline per message", 0.0),
+                          (f"write-behind {args.window_ms:g}ms/{args.batch}", args.window_ms / 1000)):
+        reset(client, args)
+        rows.append((label, asyncio.run(run(repo, scripts, args, window))))
+
+    print(f"{args.messages} messages, {args.rooms} rooms x {args.members} members, "
+          f"{args.concurrency} concurrent senders")
+    print(f"{'variant':<32}{'messages/sec':>14}")
+    for label, rate in rows:
+        print(f"{label:<32}{rate:>14,.0f}")
+    batches = repo.metrics.snapshot()["timers"].get("write_behind.batch_size")
+    if batches:
+        print(f"average flush: {batches['avg']:.1f} messages")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import hashlib
+import os
+import re
+import tempfile
+from typing import Optional
+
+HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_valid_hash(digest: str) -> bool:
+    return bool(digest and HASH_PATTERN.match(digest))
+
+
+class BlobStore:
+    """Content-addressed files on local disk, fanned out by hash prefix."""
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def path_for(self, digest: str, name: Optional[str] = None) -> str:
+        if not is_valid_hash(digest):
+            raise ValueError(f"Invalid blob hash: {digest}")
+        base = os.path.join(self.root, digest[:2], digest)
+        return os.path.join(base, name) if name else base
+
+    def exists(self, digest: str, name: Optional[str] = None) -> bool:
+        return os.path.exists(self.path_for(digest, name))
+
+    def put(self, digest: str, data: bytes, name: Optional[str] = None) -> str:
+        """Write data under its hash; existing blobs are never rewritten."""
+        path = self.path_for(digest, name)
+        if os.path.exists(path):
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as handle:
+                handle.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return path
+
+    def put_file(self, digest: str, source_path: str, name: Optional[str] = None) -> str:
+        """Move a finished file under its hash, discarding it if already stored."""
+        path = self.path_for(digest, name)
+        if os.path.exists(path):
+            os.remove(source_path)
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(source_path, path)
+        return path
+
+    def delete(self, digest: str, name: Optional[str] = None) -> bool:
+        path = self.path_for(digest, name)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,484 @@
+"""WebSocket connection registry, fan-out and liveness for users_api.
+
+A user may hold several sockets (tabs, devices), each with its own codec and
+room subscriptions. A single heartbeat task pings every socket and reaps the
+ones that have gone quiet; sends are bounded by a timeout so a half-open
+socket can't stall a broadcast or grow its write buffer without limit.
+
+Each heartbeat also refreshes the connected users' presence keys in one
+pipeline, so presence costs a write per user per interval rather than per
+frame. Typing indicators are never stored: repeats are rate-limited per
+user and room, and a room's changes are flushed together after a short
+window as one (batch) frame per socket.
+
+Read-only viewers can watch a room over Server-Sent Events instead. They
+hang off the same broadcast: each viewer is just a bounded queue of
+pre-encoded SSE frames, encoded once per broadcast for all viewers.
+
+Busy rooms can coalesce broadcasts: events arriving within a short window
+are queued per room and sent to each socket as one "batch" frame, trading a
+few milliseconds of latency for far fewer frames (and syscalls) per message.
+
+Draining (before a restart) refuses new sockets, tells every client to
+reconnect after a jittered delay, and closes sockets in batches spread over
+a window so clients don't all come back at the same moment.
+"""
+import asyncio
+import logging
+import random
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Set
+
+from fastapi import WebSocket, WebSocketDisconnect
+from fastapi.websockets import WebSocketState
+
+from metrics import Metrics
+from ws_codecs import DEFAULT_CODEC, Codec, EncodedFrames
+
+logger = logging.getLogger(__name__)
+
+
+class Connection:
+    def __init__(self, websocket: WebSocket, user_id: str, codec: Codec = DEFAULT_CODEC):
+        self.id = str(uuid.uuid4())
+        self.websocket = websocket
+        self.user_id = user_id
+        self.codec = codec
+        # Rooms this socket is viewing; None until the client first subscribes,
+        # meaning full events for every room as before subscriptions existed
+        self.subscriptions: Optional[Set[str]] = None
+        self.connected_at = time.monotonic()
+        self.last_seen = self.connected_at
+
+    def touch(self) -> None:
+        self.last_seen = time.monotonic()
+
+    def is_subscribed(self, room_id: str) -> bool:
+        return self.subscriptions is None or room_id in self.subscriptions
+
+
+def format_sse(data: str, event: str = "message", event_id: Optional[str] = None) -> str:
+    lines = []
+    if event_id:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return "\n".join(lines) + "\n\n"
+
+
+class StreamViewer:
+    """One SSE client watching one room."""
+
+    def __init__(self, room_id: str, max_queue: int):
+        self.room_id = room_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        # Set when the viewer fell too far behind or the server is draining
+        self.closed = False
+
+    def push(self, frame: Optional[str], event_id: Optional[str] = None) -> bool:
+        """Queue an encoded frame; None ends the stream"""
+        try:
+            self.queue.put_nowait(None if frame is None else (event_id, frame))
+            return True
+        except asyncio.QueueFull:
+            self.closed = True
+            return False
+
+
+class RoomEvent(NamedTuple):
+    message: Dict
+    exclude: Optional[str]
+    activity: Optional[Dict]
+    event_id: Optional[str]
+
+
+class ConnectionManager:
+    def __init__(
+        self,
+        metrics: Metrics,
+        member_ids: Callable[[str], Iterable[str]],
+        blockers: Callable[[str], Set[str]] = lambda user_id: set(),
+        presence: Callable[[List[str]], Any] = lambda user_ids: None,
+        heartbeat_interval: float = 25.0,
+        heartbeat_timeout: float = 60.0,
+        send_timeout: float = 5.0,
+        max_connections: int = 10000,
+        max_connections_per_user: int = 5,
+        max_viewer_queue: int = 100,
+        coalesce_window: float = 0.0,
+        coalesce_max_batch: int = 50,
+        typing_window: float = 0.25,
+        typing_interval: float = 2.0,
+    ):
+        self.metrics = metrics
+        self.member_ids = member_ids
+        # Ids of users who blocked a given sender; they never receive that sender's events
+        self.blockers = blockers
+        # Refreshes the presence keys of the given users
+        self.presence = presence
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.send_timeout = send_timeout
+        self.max_connections = max_connections
+        self.max_connections_per_user = max_connections_per_user
+        self.max_viewer_queue = max_viewer_queue
+        # Seconds to hold a room's events before flushing them together; 0 sends at once
+        self.coalesce_window = coalesce_window
+        self.coalesce_max_batch = max(coalesce_max_batch, 1)
+        # room id -> events waiting for the room's flush task
+        self.pending_events: Dict[str, List[RoomEvent]] = {}
+        self._flush_tasks: Dict[str, asyncio.Task] = {}
+        # Seconds to gather a room's typing changes, and the minimum gap between
+        # repeats of the same state from one user
+        self.typing_window = typing_window
+        self.typing_interval = typing_interval
+        # (room id, user id) -> (typing, when last fanned out)
+        self._typing_sent: Dict[tuple, tuple] = {}
+        # room id -> user id -> typing, waiting for the room's typing flush
+        self.pending_typing: Dict[str, Dict[str, bool]] = {}
+        self._typing_tasks: Dict[str, asyncio.Task] = {}
+        # user id -> connection id -> connection
+        self.client_connections: Dict[str, Dict[str, Connection]] = {}
+        # room id -> SSE viewers
+        self.room_viewers: Dict[str, Set[StreamViewer]] = {}
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._drain_task: Optional[asyncio.Task] = None
+        self.draining = False
+
+    def connection_count(self) -> int:
+        return sum(len(connections) for connections in self.client_connections.values())
+
+    def all_connections(self) -> List[Connection]:
+        return [
+            connection
+            for connections in self.client_connections.values()
+            for connection in connections.values()
+        ]
+
+    async def connect(
+        self, websocket: WebSocket, client_id: str, codec: Codec = DEFAULT_CODEC
+    ) -> Optional[Connection]:
+        """Register a socket, or return None if draining or at the connection cap"""
+        if self.draining or self.connection_count() >= self.max_connections:
+            self.metrics.incr("ws.rejected")
+            return None
+
+        # Oldest sockets are the likeliest to be half-open, so they make room
+        user_connections = self.client_connections.setdefault(client_id, {})
+        while len(user_connections) >= self.max_connections_per_user:
+            oldest = min(user_connections.values(), key=lambda connection: connection.connected_at)
+            self.metrics.incr("ws.evicted")
+            await self.close(oldest, code=4001, reason="Too many connections")
+
+        logger.debug("Client %s connected", client_id)
+        connection = Connection(websocket, client_id, codec)
+        self.client_connections.setdefault(client_id, {})[connection.id] = connection
+        self.record_gauges()
+        self.presence([client_id])
+        return connection
+
+    def disconnect(self, connection: Connection):
+        user_connections = self.client_connections.get(connection.user_id)
+        if user_connections is not None:
+            user_connections.pop(connection.id, None)
+            if not user_connections:
+                self.client_connections.pop(connection.user_id, None)
+        self.record_gauges()
+
+    async def close(self, connection: Connection, code: int = 1000, reason: str = ""):
+        """Drop a connection and close its socket without waiting on an unresponsive peer"""
+        self.disconnect(connection)
+        if connection.websocket.client_state != WebSocketState.CONNECTED:
+            return
+        try:
+            await asyncio.wait_for(
+                connection.websocket.close(code=code, reason=reason), self.send_timeout
+            )
+        except Exception:
+            pass
+
+    def subscribe(self, connection: Connection, room_ids: List[str]) -> Optional[Set[str]]:
+        """Add rooms to the socket's subscriptions; None (every room) is kept if room_ids is empty"""
+        if not room_ids:
+            return connection.subscriptions
+        if connection.subscriptions is None:
+            connection.subscriptions = set()
+        connection.subscriptions.update(room_ids)
+        self.record_gauges()
+        return connection.subscriptions
+
+    def unsubscribe(self, connection: Connection, room_ids: List[str]) -> Optional[Set[str]]:
+        if not room_ids:
+            return connection.subscriptions
+        if connection.subscriptions is None:
+            connection.subscriptions = set()
+        connection.subscriptions.difference_update(room_ids)
+        self.record_gauges()
+        return connection.subscriptions
+
+    def add_viewer(self, room_id: str) -> StreamViewer:
+        viewer = StreamViewer(room_id, self.max_viewer_queue)
+        self.room_viewers.setdefault(room_id, set()).add(viewer)
+        self.record_gauges()
+        return viewer
+
+    def remove_viewer(self, viewer: StreamViewer):
+        viewers = self.room_viewers.get(viewer.room_id)
+        if viewers is not None:
+            viewers.discard(viewer)
+            if not viewers:
+                self.room_viewers.pop(viewer.room_id, None)
+        self.record_gauges()
+
+    def record_gauges(self):
+        connections = self.all_connections()
+        self.metrics.gauge("ws.connections", len(connections))
+        self.metrics.gauge("ws.users", len(self.client_connections))
+        self.metrics.gauge(
+            "ws.subscribed_rooms",
+            sum(len(connection.subscriptions or ()) for connection in connections),
+        )
+        self.metrics.gauge("sse.viewers", sum(len(viewers) for viewers in self.room_viewers.values()))
+
+    async def send_frame(self, connection: Connection, frame) -> bool:
+        """Send an encoded frame; a failed or timed-out send reaps the connection"""
+        websocket = connection.websocket
+        if websocket.client_state != WebSocketState.CONNECTED:
+            self.disconnect(connection)
+            return False
+        try:
+            if connection.codec.binary:
+                await asyncio.wait_for(websocket.send_bytes(frame), self.send_timeout)
+            else:
+                await asyncio.wait_for(websocket.send_text(frame), self.send_timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.metrics.incr("ws.send_timeouts")
+            await self.reap(connection)
+        except (WebSocketDisconnect, RuntimeError):
+            self.disconnect(connection)
+        return False
+
+    async def send(self, connection: Connection, payload: Dict[str, Any]) -> bool:
+        return await self.send_frame(connection, connection.codec.encode(payload))
+
+    async def broadcast(
+        self,
+        room_id: str,
+        message: Dict,
+        exclude: Optional[str] = None,
+        activity: Optional[Dict] = None,
+        event_id: Optional[str] = None,
+    ):
+        """Send message to members viewing the room, and the lighter activity
+        ping (if any) to members connected but not subscribed to it.
+
+        Events with an event_id (from the room's replay stream) also go to the
+        room's SSE viewers. With a coalescing window the event is queued and
+        delivered by the room's flush task instead."""
+        self.metrics.incr("ws.messages")
+        event = RoomEvent(message, exclude, activity, event_id)
+        if self.coalesce_window <= 0:
+            await self.deliver(room_id, [event])
+            return
+
+        self.pending_events.setdefault(room_id, []).append(event)
+        if room_id not in self._flush_tasks:
+            self._flush_tasks[room_id] = asyncio.create_task(self.flush_room(room_id))
+
+    async def flush_room(self, room_id: str):
+        """Wait out the window, then deliver the room's queued events in order, batch by batch"""
+        try:
+            await asyncio.sleep(self.coalesce_window)
+            while self.pending_events.get(room_id):
+                pending = self.pending_events[room_id]
+                batch = pending[:self.coalesce_max_batch]
+                del pending[:self.coalesce_max_batch]
+                await self.deliver(room_id, batch)
+        finally:
+            self.pending_events.pop(room_id, None)
+            self._flush_tasks.pop(room_id, None)
+
+    async def deliver(self, room_id: str, events: List[RoomEvent]):
+        """Send one frame per connection for a run of room events"""
+        self.metrics.observe("ws.batch_size", len(events))
+        # Get all users in this room from Redis
+        user_ids = list(self.member_ids(room_id))
+
+        # Encode once per distinct frame per delivery rather than once per recipient
+        frames = EncodedFrames()
+
+        blocked = [
+            self.blockers(event.message["sender"]) if event.message.get("sender") else set()
+            for event in events
+        ]
+
+        for user_id in user_ids:
+            connections = list(self.client_connections.get(user_id, {}).values())
+            if not connections:
+                continue
+            visible = [
+                index for index, event in enumerate(events)
+                if event.exclude != user_id and user_id not in blocked[index]
+            ]
+            for connection in connections:
+                if connection.is_subscribed(room_id):
+                    kind = "full"
+                    indexes = visible
+                else:
+                    # Only the latest activity ping matters for a room the socket isn't viewing
+                    kind = "activity"
+                    indexes = [index for index in visible if events[index].activity is not None][-1:]
+                if not indexes:
+                    continue
+                key = (kind, tuple(indexes))
+                if len(indexes) == 1:
+                    event = events[indexes[0]]
+                    payload = event.message if kind == "full" else event.activity
+                else:
+                    payload = {"type": "batch", "events": [events[index].message for index in indexes]}
+                frame = frames.get(key, payload, connection.codec)
+                if await self.send_frame(connection, frame):
+                    self.metrics.incr(f"ws.frames.{kind}")
+
+        viewers = self.room_viewers.get(room_id)
+        if not viewers:
+            return
+        for index, event in enumerate(events):
+            if not event.event_id:
+                continue
+            frame = format_sse(
+                frames.get(("full", (index,)), event.message, DEFAULT_CODEC),
+                event=event.message.get("type") or "message",
+                event_id=event.event_id,
+            )
+            for viewer in list(viewers):
+                if not viewer.push(frame, event.event_id):
+                    # Too far behind; it can resume from its Last-Event-ID
+                    self.metrics.incr("sse.dropped")
+                    self.remove_viewer(viewer)
+
+    def typing_allowed(self, room_id: str, user_id: str, typing: bool) -> bool:
+        """False for a repeat of the user's last typing state inside the rate-limit interval"""
+        key = (room_id, user_id)
+        now = time.monotonic()
+        last = self._typing_sent.get(key)
+        if last and last[0] == typing and now - last[1] < self.typing_interval:
+            self.metrics.incr("ws.typing.limited")
+            return False
+        self._typing_sent[key] = (typing, now)
+        return True
+
+    def typing(self, room_id: str, user_id: str, typing: bool):
+        """Queue a typing change for the room's next typing flush"""
+        self.pending_typing.setdefault(room_id, {})[user_id] = typing
+        if room_id not in self._typing_tasks:
+            self._typing_tasks[room_id] = asyncio.create_task(self.flush_typing(room_id))
+
+    async def flush_typing(self, room_id: str):
+        try:
+            await asyncio.sleep(self.typing_window)
+            states = self.pending_typing.pop(room_id, {})
+        finally:
+            self._typing_tasks.pop(room_id, None)
+        if not states:
+            return
+        self.metrics.incr("ws.typing.flushed")
+        await self.deliver(room_id, [
+            RoomEvent(
+                {"type": "typing", "roomId": room_id, "sender": user_id, "typing": typing},
+                exclude=user_id, activity=None, event_id=None,
+            )
+            for user_id, typing in states.items()
+        ])
+
+    async def send_to_user(self, user_id: str, payload: Dict[str, Any]):
+        for connection in list(self.client_connections.get(user_id, {}).values()):
+            await self.send(connection, payload)
+
+    async def reap(self, connection: Connection):
+        logger.debug("Reaping unresponsive connection %s for %s", connection.id, connection.user_id)
+        self.metrics.incr("ws.reaped")
+        await self.close(connection, code=4000, reason="Heartbeat timeout")
+
+    async def heartbeat(self):
+        """Ping every socket each interval and reap those silent for longer than the timeout"""
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            now = time.monotonic()
+            ping = {"type": "ping", "ts": time.time()}
+            await asyncio.gather(*(
+                self.reap(connection)
+                if now - connection.last_seen > self.heartbeat_timeout
+                else self.send(connection, ping)
+                for connection in self.all_connections()
+            ))
+            # Users with a live socket stay online until their presence keys expire
+            try:
+                self.presence(list(self.client_connections))
+            except Exception:
+                logger.warning("Failed to refresh presence", exc_info=True)
+            self._typing_sent = {
+                key: sent for key, sent in self._typing_sent.items()
+                if now - sent[1] < self.typing_interval
+            }
+
+    async def drain(self, window: float, batch_size: int, max_reconnect_delay: float):
+        """Ask every client to reconnect elsewhere, then close sockets batch by batch over window seconds"""
+        self.draining = True
+        self.metrics.gauge("ws.draining", 1)
+        connections = self.all_connections()
+        random.shuffle(connections)
+        logger.info("Draining %d WebSocket connections over %ss", len(connections), window)
+
+        await asyncio.gather(*(
+            self.send(connection, {
+                "type": "reconnect",
+                "delay_ms": int(random.uniform(0, max_reconnect_delay) * 1000),
+            })
+            for connection in connections
+        ))
+
+        # SSE clients reconnect on their own after the retry hint
+        for viewers in list(self.room_viewers.values()):
+            for viewer in list(viewers):
+                retry = int(random.uniform(0, max_reconnect_delay) * 1000)
+                viewer.push(f"retry: {retry}\nevent: reconnect\ndata: {{}}\n\n")
+                viewer.push(None)
+                self.remove_viewer(viewer)
+
+        batches = [
+            connections[start:start + batch_size]
+            for start in range(0, len(connections), max(batch_size, 1))
+        ]
+        pause = window / len(batches) if batches else 0
+        for batch in batches:
+            await asyncio.gather(*(
+                self.close(connection, code=1012, reason="Server restarting")
+                for connection in batch
+            ))
+            self.metrics.incr("ws.drained", len(batch))
+            await asyncio.sleep(pause)
+
+    def start_drain(self, window: float, batch_size: int, max_reconnect_delay: float) -> asyncio.Task:
+        if self._drain_task is None:
+            self._drain_task = asyncio.create_task(
+                self.drain(window, batch_size, max_reconnect_delay)
+            )
+        return self._drain_task
+
+    def start(self):
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.create_task(self.heartbeat())
+
+    async def stop(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        # Deliver whatever is still waiting out its window
+        for room_id, task in list(self._flush_tasks.items()):
+            task.cancel()
+            events = self.pending_events.pop(room_id, [])
+            for start in range(0, len(events), self.coalesce_max_batch):
+                await self.deliver(room_id, events[start:start + self.coalesce_max_batch])
@@ -0,0 +1,79 @@
+"""Background delivery queue for users_api.
+
+Handlers store a message and hand its fan-out to a worker here instead of
+awaiting it, so the sender's latency no longer grows with the room size.
+Work is sharded by key (the room id) so each room's events are delivered by
+one worker, in the order they were stored. Queues are bounded: once a shard
+is full, submit waits for room, pushing back on senders instead of growing
+memory without limit.
+"""
+import asyncio
+import logging
+import time
+import zlib
+from typing import Any, Awaitable, Callable, List, Optional
+
+from metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+
+class DispatchQueue:
+    def __init__(self, metrics: Metrics, workers: int = 4, max_size: int = 1000):
+        self.metrics = metrics
+        self.workers = workers
+        # Bound per shard, so the whole queue holds at most max_size items
+        self.shard_size = max(max_size // max(workers, 1), 1)
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+
+    def queued(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    async def submit(self, key: str, func: Callable[..., Awaitable[Any]], *args, **kwargs):
+        """Run func(*args, **kwargs) on key's worker; inline if the workers aren't running"""
+        if not self._tasks:
+            await func(*args, **kwargs)
+            return
+        queue = self._queues[zlib.crc32(key.encode()) % len(self._queues)]
+        if queue.full():
+            self.metrics.incr("dispatch.backpressure")
+        await queue.put((time.perf_counter(), func, args, kwargs))
+        self.metrics.gauge("dispatch.queued", self.queued())
+
+    async def worker(self, queue: asyncio.Queue):
+        while True:
+            item: Optional[tuple] = await queue.get()
+            try:
+                if item is None:
+                    return
+                queued_at, func, args, kwargs = item
+                # Time from store to start of delivery
+                self.metrics.observe("dispatch.lag", time.perf_counter() - queued_at)
+                self.metrics.gauge("dispatch.queued", self.queued())
+                try:
+                    await func(*args, **kwargs)
+                    self.metrics.incr("dispatch.delivered")
+                except Exception:
+                    self.metrics.incr("dispatch.errors")
+                    logger.warning("Dispatch of %s failed", getattr(func, "__name__", func), exc_info=True)
+            finally:
+                queue.task_done()
+
+    def start(self):
+        if self._tasks or self.workers <= 0:
+            return
+        self._queues = [asyncio.Queue(maxsize=self.shard_size) for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self.worker(queue)) for queue in self._queues]
+
+    async def stop(self, timeout: float = 10.0):
+        """Finish queued deliveries (up to timeout), then stop the workers"""
+        if not self._tasks:
+            return
+        tasks, self._tasks = self._tasks, []
+        for queue in self._queues:
+            await queue.put(None)
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        self._queues = []
@@ -0,0 +1,44 @@
+import threading
+from typing import Dict
+
+
+class Metrics:
+    """In-process counters, gauges and latency timers exposed via /metrics."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+        self.timers: Dict[str, Dict[str, float]] = {}
+
+    def incr(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name: str, value: float) -> None:
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            timer = self.timers.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+            timer["count"] += 1
+            timer["total"] += value
+            timer["max"] = max(timer["max"], value)
+
+    def snapshot(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "timers": {
+                    name: {
+                        **timer,
+                        "avg": timer["total"] / timer["count"] if timer["count"] else 0.0,
+                    }
+                    for name, timer in self.timers.items()
+                },
+            }
+
+
+metrics = Metrics()
@@ -0,0 +1,1007 @@
+"""Typed access to the Redis data model used by users_api.
+
+All key construction and bytes-to-str decoding lives here. Operations issued
+inside ``Repository.batch()`` are queued on one pipeline and sent in a single
+round trip when the block exits; each queued call returns a ``Deferred`` whose
+``value`` is filled in at that point. Outside a batch, calls run immediately
+and return plain values. Every round trip is timed into ``metrics``, and
+profile reads go through an optional short-lived local cache.
+"""
+import asyncio
+import contextvars
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Union
+
+import redis
+from redis.commands.core import Script
+
+from metrics import Metrics
+
+
+def get_user_key(uuid: str) -> str:
+    return f"user:{uuid}"
+
+def get_notifications_key(user_id: str) -> str:
+    return f"user:{user_id}:notifications"
+
+def get_room_key(room_id: str) -> str:
+    return f"room:{room_id}"
+
+def get_users_key(room_id: str) -> str:
+    return f"room:{room_id}:users"
+
+def get_admins_key(room_id: str) -> str:
+    return f"room:{room_id}:admins"
+
+def get_messages_key(room_id: str) -> str:
+    return f"room:{room_id}:messages"
+
+def get_user_rooms_key(user_id: str) -> str:
+    return f"user:{user_id}:rooms"
+
+def get_user_activity_key(user_id: str) -> str:
+    return f"user:{user_id}:activity"
+
+def get_user_read_key(user_id: str) -> str:
+    return f"user:{user_id}:read"
+
+def get_user_unread_key(user_id: str) -> str:
+    return f"user:{user_id}:unread"
+
+def get_user_mentions_key(user_id: str) -> str:
+    return f"user:{user_id}:mentions"
+
+def get_user_presence_key(user_id: str) -> str:
+    return f"user:{user_id}:presence"
+
+def get_user_mention_inbox_key(user_id: str) -> str:
+    return f"user:{user_id}:mentioned"
+
+def get_room_summary_key(room_id: str) -> str:
+    return f"room:{room_id}:summary"
+
+def get_orgs_key() -> str:
+    return "orgs"
+
+def get_org_key(org_id: str) -> str:
+    return f"org:{org_id}"
+
+def get_org_rooms_key(org_id: str) -> str:
+    return f"org:{org_id}:rooms"
+
+def get_org_events_key(org_id: str) -> str:
+    return f"org:{org_id}:events"
+
+def get_pubsub_key(room_id: str) -> str:
+    return f"room:{room_id}:pubsub"
+
+def get_room_events_key(room_id: str) -> str:
+    return f"room:{room_id}:events"
+
+def get_room_timeline_key(room_id: str) -> str:
+    return f"room:{room_id}:timeline"
+
+def get_room_timeline_backfilled_key(room_id: str) -> str:
+    return f"room:{room_id}:timeline:backfilled"
+
+def get_room_threads_key(room_id: str) -> str:
+    return f"room:{room_id}:threads"
+
+def get_room_thread_key(room_id: str, root_id: str) -> str:
+    return f"room:{room_id}:thread:{root_id}"
+
+def get_room_thread_summary_key(room_id: str, root_id: str) -> str:
+    return f"room:{room_id}:thread:{root_id}:summary"
+
+def get_room_replies_key(room_id: str) -> str:
+    return f"room:{room_id}:replies"
+
+def get_room_search_docs_key(room_id: str) -> str:
+    return f"room:{room_id}:search:docs"
+
+def get_room_search_terms_key(room_id: str) -> str:
+    return f"room:{room_id}:search:terms"
+
+def get_room_search_term_key(room_id: str, term: str) -> str:
+    return f"room:{room_id}:search:term:{term}"
+
+def get_room_search_results_key(room_id: str, terms: List[str]) -> str:
+    return f"room:{room_id}:search:results:{' '.join(sorted(terms))}"
+
+def get_user_blocks_key(user_id: str) -> str:
+    return f"user:{user_id}:blocked"
+
+def get_user_blocked_by_key(user_id: str) -> str:
+    return f"user:{user_id}:blocked_by"
+
+def get_reports_key() -> str:
+    return "reports"
+
+def get_room_payloads_key(room_id: str) -> str:
+    return f"room:{room_id}:payloads"
+
+def get_room_payload_refs_key(room_id: str) -> str:
+    return f"room:{room_id}:payload_refs"
+
+def get_payload_rooms_key(payload_hash: str) -> str:
+    return f"payload:{payload_hash}:rooms"
+
+def get_upload_key(upload_id: str) -> str:
+    return f"upload:{upload_id}"
+
+def get_attachment_key(attachment_id: str) -> str:
+    return f"attachment:{attachment_id}"
+
+def get_attachment_uploaders_key(attachment_id: str) -> str:
+    return f"attachment:{attachment_id}:uploaders"
+
+def get_attachment_rooms_key(attachment_id: str) -> str:
+    return f"attachment:{attachment_id}:rooms"
+
+def get_version_key(resource: str) -> str:
+    return f"version:{resource}"
+
+
+def decode(value: Optional[bytes]) -> Optional[str]:
+    return value.decode() if isinstance(value, bytes) else value
+
+def decode_hash(raw: Optional[Dict[bytes, bytes]]) -> Dict[str, str]:
+    return {decode(k): decode(v) for k, v in (raw or {}).items()}
+
+def decode_members(raw: Optional[Iterable[bytes]]) -> List[str]:
+    return [decode(member) for member in (raw or [])]
+
+def decode_fields(fields: Iterable[str]) -> Callable[[Optional[List[bytes]]], Dict[str, str]]:
+    """Decoder for HMGET replies; an all-missing reply means the hash does not exist."""
+    fields = list(fields)
+
+    def decoder(raw):
+        values = [decode(value) for value in (raw or [])]
+        if not any(value is not None for value in values):
+            return {}
+        return dict(zip(fields, values))
+
+    return decoder
+
+def decode_counts(raw: Optional[Dict[bytes, bytes]]) -> Dict[str, int]:
+    return {decode(k): int(v) for k, v in (raw or {}).items()}
+
+def decode_int_list(raw: Optional[Iterable[bytes]]) -> List[int]:
+    return [int(value or 0) for value in (raw or [])]
+
+def decode_json_list(raw: Optional[Iterable[bytes]]) -> List[Any]:
+    items = []
+    for item in raw or []:
+        try:
+            items.append(json.loads(item))
+        except (TypeError, ValueError):
+            continue
+    return items
+
+
+class Deferred:
+    """Result of a call queued inside a batch; available once the batch executes."""
+
+    __slots__ = ("_decoder", "_value", "_error", "resolved")
+
+    def __init__(self, decoder: Callable[[Any], Any]):
+        self._decoder = decoder
+        self._value = None
+        self._error: Optional[Exception] = None
+        self.resolved = False
+
+    def resolve(self, raw: Any) -> None:
+        if isinstance(raw, Exception):
+            self._error = raw
+        else:
+            self._value = self._decoder(raw)
+        self.resolved = True
+
+    @property
+    def value(self) -> Any:
+        if not self.resolved:
+            raise RuntimeError("Batch has not been executed yet")
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    @property
+    def error(self) -> Optional[Exception]:
+        return self._error
+
+    def value_or(self, default: Any) -> Any:
+        """The value, or default if the command failed (e.g. WRONGTYPE)."""
+        try:
+            return self.value
+        except redis.exceptions.ResponseError:
+            return default
+
+
+Result = Union[Any, Deferred]
+
+_active_batch: contextvars.ContextVar[Optional["Batch"]] = contextvars.ContextVar(
+    "redis_batch", default=None
+)
+
+
+# Processes publish "<cache>:<key>" here when a cached entry goes stale, so
+# the others drop their copy too
+INVALIDATION_CHANNEL = "invalidate:cache"
+
+# Reads whose errors stay on their Deferred for the caller (value / value_or);
+# an error from any other command or script fails the whole batch
+READ_COMMANDS = frozenset({
+    "exists", "get", "mget", "hget", "hgetall", "hmget", "hlen", "hexists",
+    "smembers", "sismember", "scard", "lrange", "llen", "lindex",
+    "zcard", "zscore", "zcount", "zrange", "zrevrange", "zrevrangebyscore", "xrange",
+})
+
+
+class Batch:
+    def __init__(self, client: redis.Redis, raise_errors: bool = True):
+        self.pipe = client.pipeline(transaction=False)
+        # False leaves failed writes on their Deferreds for the caller to sort out
+        self.raise_errors = raise_errors
+        self.pending: List[Deferred] = []
+        # Deferreds whose failure must be raised when the batch executes
+        self.checked: List[Deferred] = []
+        # Run once the queued commands have been sent, e.g. cache invalidation
+        self.callbacks: List[Callable[[], Any]] = []
+
+    def add(self, method: str, args: tuple, kwargs: Dict[str, Any], decoder: Callable[[Any], Any]) -> Deferred:
+        getattr(self.pipe, method)(*args, **kwargs)
+        deferred = Deferred(decoder)
+        self.pending.append(deferred)
+        if method not in READ_COMMANDS:
+            self.checked.append(deferred)
+        return deferred
+
+    def add_script(self, script: Script, keys: List[str], args: List[Any], decoder: Callable[[Any], Any]) -> Deferred:
+        script(keys=keys, args=args, client=self.pipe)
+        deferred = Deferred(decoder)
+        self.pending.append(deferred)
+        self.checked.append(deferred)
+        return deferred
+
+    def after(self, callback: Callable[[], Any]) -> None:
+        self.callbacks.append(callback)
+
+    def checkpoint(self) -> tuple:
+        """Position to roll back to, or to collect the Deferreds queued since"""
+        return len(self.pending), len(self.checked), len(self.callbacks)
+
+    def rollback(self, checkpoint: tuple) -> None:
+        """Drop everything queued since checkpoint, so it is never sent"""
+        pending, checked, callbacks = checkpoint
+        del self.pipe.command_stack[pending:]
+        del self.pending[pending:]
+        del self.checked[checked:]
+        del self.callbacks[callbacks:]
+
+    def checked_since(self, checkpoint: tuple) -> List[Deferred]:
+        return self.checked[checkpoint[1]:]
+
+    def execute(self) -> None:
+        """Run the pipeline, then the after() callbacks; raises the first failed
+        write, as it would outside a batch"""
+        if self.pending:
+            for deferred, raw in zip(self.pending, self.pipe.execute(raise_on_error=False)):
+                deferred.resolve(raw)
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+        checked, self.checked = self.checked, []
+        self.pending = []
+        if not self.raise_errors:
+            return
+        for deferred in checked:
+            if deferred.error is not None:
+                raise deferred.error
+
+
+class TTLCache:
+    """Size-bounded LRU whose entries also expire after ttl seconds."""
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, key: str) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def drop(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class Store:
+    """Shared plumbing: runs a Redis command now, or queues it on the active batch."""
+
+    def __init__(self, repo: "Repository"):
+        self.repo = repo
+
+    def _call(
+        self, method: str, *args: Any, decoder: Callable[[Any], Any] = lambda raw: raw, **kwargs: Any
+    ) -> Result:
+        batch = _active_batch.get()
+        if batch is not None:
+            return batch.add(method, args, kwargs, decoder)
+        started = time.perf_counter()
+        raw = getattr(self.repo.client, method)(*args, **kwargs)
+        self.repo.metrics.observe(f"redis.{method}", time.perf_counter() - started)
+        return decoder(raw)
+
+
+class UserStore(Store):
+    def get(self, user_id: str) -> Result:
+        cached = self.repo.cache_get(get_user_key(user_id))
+        if cached is not None:
+            return cached
+
+        def decode_profile(raw):
+            profile = decode_hash(raw)
+            self.repo.cache_set(get_user_key(user_id), dict(profile))
+            return profile
+
+        return self._call("hgetall", get_user_key(user_id), decoder=decode_profile)
+
+    def get_many(self, user_ids: List[str]) -> Dict[str, Dict[str, str]]:
+        with self.repo.batch():
+            pending = {user_id: self.get(user_id) for user_id in user_ids}
+        return {
+            user_id: result.value_or({}) if isinstance(result, Deferred) else result
+            for user_id, result in pending.items()
+        }
+
+    def exists(self, user_id: str) -> Result:
+        return self._call("exists", get_user_key(user_id), decoder=bool)
+
+    def save(self, user_id: str, fields: Dict[str, Any]) -> Result:
+        self.repo.cache_drop(get_user_key(user_id))
+        return self._call("hset", get_user_key(user_id), None, None, fields)
+
+    def remove_fields(self, user_id: str, *fields: str) -> Result:
+        self.repo.cache_drop(get_user_key(user_id))
+        return self._call("hdel", get_user_key(user_id), *fields)
+
+    def delete(self, user_id: str) -> Result:
+        self.repo.cache_drop(get_user_key(user_id))
+        return self._call(
+            "delete",
+            get_user_key(user_id),
+            get_user_rooms_key(user_id),
+            get_user_activity_key(user_id),
+            get_user_read_key(user_id),
+            get_user_unread_key(user_id),
+            get_user_mentions_key(user_id),
+            get_notifications_key(user_id),
+            get_user_blocks_key(user_id),
+            get_user_blocked_by_key(user_id),
+            get_user_mention_inbox_key(user_id),
+        )
+
+    def room_ids(self, user_id: str) -> Result:
+        return self._call("smembers", get_user_rooms_key(user_id), decoder=decode_members)
+
+    def room_count(self, user_id: str) -> Result:
+        return self._call("scard", get_user_rooms_key(user_id))
+
+    def blocked_ids(self, user_id: str) -> Result:
+        return self._call("smembers", get_user_blocks_key(user_id), decoder=decode_members)
+
+    def blocked_by_ids(self, user_id: str) -> Result:
+        return self._call("smembers", get_user_blocked_by_key(user_id), decoder=decode_members)
+
+    def block(self, user_id: str, target_id: str) -> None:
+        """Record the block and its reverse index entry in one round trip"""
+        with self.repo.batch():
+            self._call("sadd", get_user_blocks_key(user_id), target_id)
+            self._call("sadd", get_user_blocked_by_key(target_id), user_id)
+        self.repo.drop_blockers(target_id)
+
+    def unblock(self, user_id: str, target_id: str) -> None:
+        with self.repo.batch():
+            self._call("srem", get_user_blocks_key(user_id), target_id)
+            self._call("srem", get_user_blocked_by_key(target_id), user_id)
+        self.repo.drop_blockers(target_id)
+
+
+class RoomStore(Store):
+    def exists(self, room_id: str) -> Result:
+        return self._call("exists", get_room_key(room_id), decoder=bool)
+
+    def get(self, room_id: str) -> Result:
+        return self._call("hgetall", get_room_key(room_id), decoder=decode_hash)
+
+    def get_many(self, room_ids: List[str]) -> Dict[str, Dict[str, str]]:
+        with self.repo.batch():
+            pending = {room_id: self.get(room_id) for room_id in room_ids}
+        return {room_id: result.value_or({}) for room_id, result in pending.items()}
+
+    def get_fields(self, room_id: str, fields: List[str]) -> Result:
+        return self._call("hmget", get_room_key(room_id), fields, decoder=decode_fields(fields))
+
+    def get_fields_many(self, room_ids: List[str], fields: List[str]) -> Dict[str, Dict[str, str]]:
+        with self.repo.batch():
+            pending = {room_id: self.get_fields(room_id, fields) for room_id in room_ids}
+        return {room_id: result.value_or({}) for room_id, result in pending.items()}
+
+    def member_ids(self, room_id: str) -> Result:
+        return self._call("smembers", get_users_key(room_id), decoder=decode_members)
+
+    def admin_ids(self, room_id: str) -> Result:
+        return self._call("smembers", get_admins_key(room_id), decoder=decode_members)
+
+    def member_count(self, room_id: str) -> Result:
+        return self._call("scard", get_users_key(room_id))
+
+    def is_member(self, room_id: str, user_id: str) -> Result:
+        return self._call("sismember", get_users_key(room_id), user_id, decoder=bool)
+
+    def is_admin(self, room_id: str, user_id: str) -> Result:
+        return self._call("sismember", get_admins_key(room_id), user_id, decoder=bool)
+
+    def is_public(self, room_id: str) -> Result:
+        return self._call(
+            "hget", get_room_key(room_id), "is_public",
+            decoder=lambda raw: decode(raw) == "1",
+        )
+
+    def update(self, room_id: str, fields: Dict[str, Any]) -> Result:
+        return self._call("hset", get_room_key(room_id), None, None, fields)
+
+    def remove_member(self, room_id: str, user_id: str) -> None:
+        with self.repo.batch():
+            self._call("srem", get_users_key(room_id), user_id)
+            self._call("srem", get_admins_key(room_id), user_id)
+            self._call("srem", get_user_rooms_key(user_id), room_id)
+            self._call("zrem", get_user_activity_key(user_id), room_id)
+
+
+class OrgStore(Store):
+    def ids(self) -> Result:
+        return self._call("smembers", get_orgs_key(), decoder=decode_members)
+
+    def get(self, org_id: str) -> Result:
+        return self._call("hgetall", get_org_key(org_id), decoder=decode_hash)
+
+    def get_many(self, org_ids: List[str]) -> Dict[str, Dict[str, str]]:
+        with self.repo.batch():
+            pending = {org_id: self.get(org_id) for org_id in org_ids}
+        return {org_id: result.value_or({}) for org_id, result in pending.items()}
+
+    def get_fields(self, org_id: str, fields: List[str]) -> Result:
+        return self._call("hmget", get_org_key(org_id), fields, decoder=decode_fields(fields))
+
+    def get_fields_many(self, org_ids: List[str], fields: List[str]) -> Dict[str, Dict[str, str]]:
+        with self.repo.batch():
+            pending = {org_id: self.get_fields(org_id, fields) for org_id in org_ids}
+        return {org_id: result.value_or({}) for org_id, result in pending.items()}
+
+    def exists(self, org_id: str) -> Result:
+        return self._call("exists", get_org_key(org_id), decoder=bool)
+
+    def create(self, org_id: str, fields: Dict[str, Any]) -> None:
+        with self.repo.batch():
+            self._call("hset", get_org_key(org_id), None, None, fields)
+            self._call("sadd", get_orgs_key(), org_id)
+
+    def add_rooms(self, org_id: str, *room_ids: str) -> Result:
+        return self._call("sadd", get_org_rooms_key(org_id), *room_ids)
+
+    def add_events(self, org_id: str, *events: Dict[str, Any]) -> Result:
+        return self._call(
+            "rpush", get_org_events_key(org_id), *[json.dumps(event) for event in events]
+        )
+
+    def room_ids(self, org_id: str) -> Result:
+        return self._call("smembers", get_org_rooms_key(org_id), decoder=decode_members)
+
+    def events(self, org_id: str) -> Result:
+        return self._call("lrange", get_org_events_key(org_id), 0, -1, decoder=decode_json_list)
+
+
+class NotificationStore(Store):
+    def add(self, user_id: str, notification: Dict[str, Any]) -> Result:
+        return self._call(
+            "hset", get_notifications_key(user_id), notification["id"], json.dumps(notification)
+        )
+
+    def list(self, user_id: str) -> Result:
+        return self._call(
+            "hgetall", get_notifications_key(user_id),
+            decoder=lambda raw: decode_json_list((raw or {}).values()),
+        )
+
+    def remove(self, user_id: str, notification_id: str) -> Result:
+        return self._call("hdel", get_notifications_key(user_id), notification_id)
+
+
+class MessageStore(Store):
+    def push(self, room_id: str, message: Dict[str, Any]) -> Result:
+        return self._call("lpush", get_messages_key(room_id), json.dumps(message))
+
+    def range(self, room_id: str, start: int = 0, end: int = -1) -> Result:
+        return self._call("lrange", get_messages_key(room_id), start, end, decoder=decode_json_list)
+
+    def raw_range(self, room_id: str, start: int = 0, end: int = -1) -> Result:
+        return self._call("lrange", get_messages_key(room_id), start, end)
+
+    def publish(self, room_id: str, message_json: str) -> Result:
+        return self._call("publish", get_pubsub_key(room_id), message_json)
+
+    def set(self, room_id: str, index: int, message: Dict[str, Any]) -> Result:
+        return self._call("lset", get_messages_key(room_id), index, json.dumps(message))
+
+    def length(self, room_id: str) -> Result:
+        return self._call("llen", get_messages_key(room_id))
+
+    def index_time(self, room_id: str, scores: Dict[str, float]) -> Result:
+        """Add messages (id -> epoch seconds) to the room's time index."""
+        return self._call("zadd", get_room_timeline_key(room_id), scores)
+
+    def unindex_time(self, room_id: str, member: str) -> Result:
+        return self._call("zrem", get_room_timeline_key(room_id), member)
+
+    def time_backfilled(self, room_id: str) -> Result:
+        """Whether messages posted before the time index existed have been added to it."""
+        return self._call("exists", get_room_timeline_backfilled_key(room_id), decoder=bool)
+
+    def mark_time_backfilled(self, room_id: str) -> Result:
+        return self._call("set", get_room_timeline_backfilled_key(room_id), 1)
+
+    def time_score(self, room_id: str, member: str) -> Result:
+        return self._call("zscore", get_room_timeline_key(room_id), member)
+
+    def count_newer(self, room_id: str, score: float) -> Result:
+        """Messages posted after score, i.e. the list index of the first one at or before it."""
+        return self._call("zcount", get_room_timeline_key(room_id), f"({score}", "+inf")
+
+    def append_event(self, room_id: str, event: Dict[str, Any], max_length: int) -> Result:
+        """Add a broadcast event to the room's capped replay stream; returns its id."""
+        return self._call(
+            "xadd", get_room_events_key(room_id),
+            {"event": event.get("type") or "message", "data": json.dumps(event)},
+            maxlen=max_length, approximate=True, decoder=decode,
+        )
+
+    def events_after(self, room_id: str, last_event_id: str, count: int) -> Result:
+        return self._call(
+            "xrange", get_room_events_key(room_id), min=f"({last_event_id}", max="+", count=count,
+            decoder=lambda raw: [
+                (decode(event_id), decode(fields[b"event"]), decode(fields[b"data"]))
+                for event_id, fields in raw or []
+            ],
+        )
+
+    def remove_at(self, room_id: str, index: int, message_id: str) -> None:
+        # Lists can't delete by index, so overwrite with a unique tombstone and remove it
+        tombstone = json.dumps({"_deleted": True, "content_uuid": message_id})
+        with self.repo.batch():
+            self._call("lset", get_messages_key(room_id), index, tombstone)
+            self._call("lrem", get_messages_key(room_id), 1, tombstone)
+
+
+class ActivityStore(Store):
+    """Per-user rooms ordered by last activity, and each room's latest-message summary."""
+
+    def page(self, user_id: str, start: int, stop: int) -> Result:
+        return self._call(
+            "zrevrange", get_user_activity_key(user_id), start, stop, withscores=True,
+            decoder=lambda raw: [(decode(room_id), score) for room_id, score in raw or []],
+        )
+
+    def count(self, user_id: str) -> Result:
+        return self._call("zcard", get_user_activity_key(user_id))
+
+    def touch(self, user_id: str, scores: Dict[str, float]) -> Result:
+        """Add rooms missing from the index without moving existing ones."""
+        return self._call("zadd", get_user_activity_key(user_id), scores, nx=True)
+
+    def summary(self, room_id: str) -> Result:
+        return self._call("hgetall", get_room_summary_key(room_id), decoder=decode_hash)
+
+    def summaries(self, room_ids: List[str]) -> Dict[str, Dict[str, str]]:
+        with self.repo.batch():
+            pending = {room_id: self.summary(room_id) for room_id in room_ids}
+        return {room_id: result.value_or({}) for room_id, result in pending.items()}
+
+    def set_summary(self, room_id: str, fields: Dict[str, Any]) -> Result:
+        return self._call("hset", get_room_summary_key(room_id), mapping=fields)
+
+    def bump(self, user_id: str, room_id: str, score: float) -> Result:
+        return self._call("zadd", get_user_activity_key(user_id), {room_id: score})
+
+
+class UnreadStore(Store):
+    """Per-user read markers and the unread/mention counters maintained at post time."""
+
+    def markers(self, user_id: str) -> Result:
+        return self._call("hgetall", get_user_read_key(user_id), decoder=decode_hash)
+
+    def marker(self, user_id: str, room_id: str) -> Result:
+        return self._call("hget", get_user_read_key(user_id), room_id, decoder=decode)
+
+    def counts(self, user_id: str) -> Result:
+        return self._call("hgetall", get_user_unread_key(user_id), decoder=decode_counts)
+
+    def mentions(self, user_id: str) -> Result:
+        return self._call("hgetall", get_user_mentions_key(user_id), decoder=decode_counts)
+
+    def counts_for(self, user_id: str, room_ids: List[str]) -> Dict[str, tuple]:
+        """(unread, mentions) for each room, in one round trip."""
+        if not room_ids:
+            return {}
+        with self.repo.batch():
+            unread = self._call("hmget", get_user_unread_key(user_id), room_ids, decoder=decode_int_list)
+            mentions = self._call("hmget", get_user_mentions_key(user_id), room_ids, decoder=decode_int_list)
+        return dict(zip(room_ids, zip(unread.value, mentions.value)))
+
+    def incr(self, user_id: str, room_id: str, mentioned: bool = False) -> None:
+        self._call("hincrby", get_user_unread_key(user_id), room_id, 1)
+        if mentioned:
+            self._call("hincrby", get_user_mentions_key(user_id), room_id, 1)
+
+    def mark_read(self, user_id: str, room_id: str, message_id: str, unread: int, mentions: int) -> None:
+        with self.repo.batch():
+            self._call("hset", get_user_read_key(user_id), room_id, message_id)
+            for key, count in (
+                (get_user_unread_key(user_id), unread),
+                (get_user_mentions_key(user_id), mentions),
+            ):
+                if count:
+                    self._call("hset", key, room_id, count)
+                else:
+                    self._call("hdel", key, room_id)
+
+
+class MentionStore(Store):
+    """Per-user inbox of the messages that mention them, scored by post time.
+
+    Members are JSON [room id, message id, sender] so an entry can be
+    removed again from the message alone."""
+
+    @staticmethod
+    def entry(room_id: str, message_id: str, sender: str) -> str:
+        return json.dumps([room_id, message_id, sender])
+
+    def add(self, user_id: str, entry: str, score: float, max_length: int) -> None:
+        """Add an entry, dropping the oldest beyond max_length"""
+        key = get_user_mention_inbox_key(user_id)
+        with self.repo.batch():
+            self._call("zadd", key, {entry: score})
+            self._call("zremrangebyrank", key, 0, -max_length - 1)
+
+    def remove(self, user_id: str, entry: str) -> Result:
+        return self._call("zrem", get_user_mention_inbox_key(user_id), entry)
+
+    def page(self, user_id: str, max_score: Optional[float], offset: int, count: int) -> Result:
+        """Up to count entries scored at or below max_score, newest first, skipping offset"""
+        return self._call(
+            "zrevrangebyscore", get_user_mention_inbox_key(user_id),
+            max_score if max_score is not None else "+inf", "-inf",
+            start=offset, num=count, withscores=True,
+            decoder=lambda raw: [(decode(entry), score) for entry, score in raw or []],
+        )
+
+
+class SearchStore(Store):
+    """Per-room inverted index of plaintext messages: a sorted set per term of
+    message id -> term weight, plus the indexed fields of each message."""
+
+    def add(self, room_id: str, doc_id: str, document: Dict[str, Any], weights: Dict[str, float]) -> None:
+        with self.repo.batch():
+            self._call(
+                "hset", get_room_search_docs_key(room_id), doc_id,
+                json.dumps({**document, "terms": list(weights)}),
+            )
+            for term, weight in weights.items():
+                self._call("zadd", get_room_search_term_key(room_id, term), {doc_id: weight})
+            if weights:
+                self._call("sadd", get_room_search_terms_key(room_id), *weights)
+
+    def remove(self, room_id: str, doc_id: str, terms: Iterable[str]) -> None:
+        with self.repo.batch():
+            for term in terms:
+                self._call("zrem", get_room_search_term_key(room_id, term), doc_id)
+            self._call("hdel", get_room_search_docs_key(room_id), doc_id)
+
+    def document(self, room_id: str, doc_id: str) -> Result:
+        return self._call(
+            "hget", get_room_search_docs_key(room_id), doc_id,
+            decoder=lambda raw: json.loads(raw) if raw else None,
+        )
+
+    def documents(self, room_id: str, doc_ids: List[str]) -> Result:
+        if not doc_ids:
+            return {}
+        return self._call(
+            "hmget", get_room_search_docs_key(room_id), doc_ids,
+            decoder=lambda raw: {
+                doc_id: json.loads(doc) for doc_id, doc in zip(doc_ids, raw) if doc
+            },
+        )
+
+    def term_counts(self, room_id: str, terms: List[str]) -> Dict[str, int]:
+        """Indexed message count for the room, and per term"""
+        with self.repo.batch():
+            total = self._call("hlen", get_room_search_docs_key(room_id))
+            counts = {term: self._call("zcard", get_room_search_term_key(room_id, term)) for term in terms}
+        return {"": total.value, **{term: count.value for term, count in counts.items()}}
+
+    def ranked(
+        self, room_id: str, weights: Dict[str, float], start: int, stop: int, ttl: int,
+        refresh: bool = False,
+    ) -> List[tuple]:
+        """(message id, score) pairs start..stop of the weighted union of the
+        terms' sets; the union is kept for ttl seconds so later pages reuse it,
+        and rebuilt when refresh is set so a new search sees new messages"""
+        results_key = get_room_search_results_key(room_id, list(weights))
+        if refresh or not self.repo.client.exists(results_key):
+            with self.repo.batch():
+                self._call(
+                    "zunionstore", results_key,
+                    {get_room_search_term_key(room_id, term): weight for term, weight in weights.items()},
+                )
+                self._call("expire", results_key, ttl)
+        return self._call(
+            "zrevrange", results_key, start, stop, withscores=True,
+            decoder=lambda raw: [(decode(doc_id), score) for doc_id, score in raw or []],
+        )
+
+    def drop(self, room_id: str) -> None:
+        terms = decode_members(self.repo.client.smembers(get_room_search_terms_key(room_id)))
+        keys = [get_room_search_term_key(room_id, term) for term in terms]
+        keys += [get_room_search_docs_key(room_id), get_room_search_terms_key(room_id)]
+        with self.repo.batch():
+            for start in range(0, len(keys), 500):
+                self._call("delete", *keys[start:start + 500])
+
+
+class ThreadStore(Store):
+    """Replies grouped by the root message they answer: per thread, reply ids
+    by time and a summary with the reply count; reply bodies by id per room."""
+
+    def add_reply(self, room_id: str, root_id: str, reply_id: str, message: Dict[str, Any], score: float) -> None:
+        summary_key = get_room_thread_summary_key(room_id, root_id)
+        with self.repo.batch():
+            self._call("zadd", get_room_thread_key(room_id, root_id), {reply_id: score})
+            self._call("hset", get_room_replies_key(room_id), reply_id, json.dumps(message))
+            self._call("hincrby", summary_key, "reply_count", 1)
+            self._call("hset", summary_key, mapping={
+                "last_reply_at": message.get("timestamp") or "",
+                "last_reply_sender": message.get("sender") or "",
+            })
+            self._call("sadd", get_room_threads_key(room_id), root_id)
+
+    def set_reply(self, room_id: str, reply_id: str, message: Dict[str, Any]) -> Result:
+        return self._call("hset", get_room_replies_key(room_id), reply_id, json.dumps(message))
+
+    def remove_reply(self, room_id: str, root_id: str, reply_id: str) -> None:
+        with self.repo.batch():
+            self._call("zrem", get_room_thread_key(room_id, root_id), reply_id)
+            self._call("hdel", get_room_replies_key(room_id), reply_id)
+            self._call("hincrby", get_room_thread_summary_key(room_id, root_id), "reply_count", -1)
+
+    def reply(self, room_id: str, reply_id: str) -> Result:
+        return self._call(
+            "hget", get_room_replies_key(room_id), reply_id,
+            decoder=lambda raw: json.loads(raw) if raw else None,
+        )
+
+    def page(self, room_id: str, root_id: str, start: int, stop: int) -> List[Dict[str, Any]]:
+        """Replies start..stop of the thread, oldest first"""
+        reply_ids = decode_members(self.repo.client.zrange(get_room_thread_key(room_id, root_id), start, stop))
+        if not reply_ids:
+            return []
+        return self._call(
+            "hmget", get_room_replies_key(room_id), reply_ids,
+            decoder=lambda raw: [json.loads(reply) for reply in raw if reply],
+        )
+
+    def summary(self, room_id: str, root_id: str) -> Result:
+        return self._call("hgetall", get_room_thread_summary_key(room_id, root_id), decoder=decode_hash)
+
+    def summaries(self, room_id: str, root_ids: List[str]) -> Dict[str, Dict[str, str]]:
+        with self.repo.batch():
+            pending = {root_id: self.summary(room_id, root_id) for root_id in root_ids}
+        return {root_id: result.value_or({}) for root_id, result in pending.items()}
+
+    def drop(self, room_id: str) -> None:
+        root_ids = self.repo.client.smembers(get_room_threads_key(room_id))
+        keys = [get_room_threads_key(room_id), get_room_replies_key(room_id)]
+        for root_id in decode_members(root_ids):
+            keys += [get_room_thread_key(room_id, root_id), get_room_thread_summary_key(room_id, root_id)]
+        with self.repo.batch():
+            for start in range(0, len(keys), 500):
+                self._call("delete", *keys[start:start + 500])
+
+
+class PresenceStore(Store):
+    """Last-heartbeat timestamps in keys that expire when a user's sockets go quiet."""
+
+    def touch(self, user_ids: Iterable[str], ttl: int) -> None:
+        now = int(time.time())
+        with self.repo.batch():
+            for user_id in user_ids:
+                self._call("set", get_user_presence_key(user_id), now, ex=ttl)
+
+    def last_seen(self, user_ids: List[str]) -> Result:
+        """Map each online user to their last heartbeat; offline users are left out"""
+        if not user_ids:
+            return {}
+        return self._call(
+            "mget", [get_user_presence_key(user_id) for user_id in user_ids],
+            decoder=lambda raw: {
+                user_id: int(seen) for user_id, seen in zip(user_ids, raw) if seen is not None
+            },
+        )
+
+
+class VersionStore(Store):
+    def bump(self, *resources: str) -> None:
+        with self.repo.batch():
+            for resource in resources:
+                self._call("incr", get_version_key(resource))
+
+    def get(self, *resources: str) -> Result:
+        return self._call(
+            "mget", [get_version_key(resource) for resource in resources],
+            decoder=lambda raw: [decode(version) for version in raw],
+        )
+
+
+class Repository:
+    def __init__(
+        self, client: redis.Redis, metrics: Metrics, cache_ttl: float = 0.0, blockers_ttl: float = 30.0,
+        cache_size: int = 10000,
+    ):
+        self.client = client
+        self.metrics = metrics
+        self.cache_ttl = cache_ttl
+        self._cache = TTLCache(cache_ttl, cache_size)
+        self.blockers_ttl = blockers_ttl
+        # user id -> ids of users who blocked them
+        self._blockers = TTLCache(blockers_ttl, cache_size)
+        # Caches other processes can invalidate, by name
+        self._caches = {"profiles": self._cache, "blockers": self._blockers}
+        self.users = UserStore(self)
+        self.rooms = RoomStore(self)
+        self.orgs = OrgStore(self)
+        self.notifications = NotificationStore(self)
+        self.messages = MessageStore(self)
+        self.activity = ActivityStore(self)
+        self.unread = UnreadStore(self)
+        self.mentions = MentionStore(self)
+        self.search = SearchStore(self)
+        self.threads = ThreadStore(self)
+        self.presence = PresenceStore(self)
+        self.versions = VersionStore(self)
+
+    @contextmanager
+    def batch(self, raise_errors: bool = True) -> Iterator[Batch]:
+        """Queue every repository call in this block onto one pipeline.
+
+        Nested blocks join the outermost batch. With raise_errors=False, failed
+        writes stay on their Deferreds instead of being raised on exit.
+        """
+        outer = _active_batch.get()
+        if outer is not None:
+            yield outer
+            return
+        batch = Batch(self.client, raise_errors)
+        token = _active_batch.set(batch)
+        try:
+            yield batch
+        finally:
+            _active_batch.reset(token)
+        started = time.perf_counter()
+        size = len(batch.pending)
+        batch.execute()
+        if size:
+            self.metrics.observe("redis.pipeline", time.perf_counter() - started)
+            self.metrics.observe("redis.pipeline_size", size)
+
+    def run_script(
+        self, script: Script, keys: List[str], args: List[Any],
+        decoder: Callable[[Any], Any] = lambda raw: raw,
+    ) -> Result:
+        """Run a registered Lua script, queued on the active batch if there is one."""
+        batch = _active_batch.get()
+        if batch is not None:
+            return batch.add_script(script, keys, args, decoder)
+        started = time.perf_counter()
+        raw = script(keys=keys, args=args)
+        self.metrics.observe("redis.evalsha", time.perf_counter() - started)
+        return decoder(raw)
+
+    def cache_get(self, key: str) -> Optional[Dict[str, str]]:
+        value = self._cache.get(key)
+        return dict(value) if value is not None else None
+
+    def cache_set(self, key: str, value: Dict[str, str]) -> None:
+        self._cache.set(key, value)
+
+    def cache_drop(self, key: str) -> None:
+        self._cache.drop(key)
+        self.invalidate("profiles", key)
+
+    def blockers(self, user_id: str) -> Set[str]:
+        """Users who blocked user_id, cached per process so fan-out checks are set lookups.
+
+        Blocks drop the entry on this process and, via watch_invalidations,
+        on the others once the block is written.
+        """
+        blockers = self._blockers.get(user_id)
+        if blockers is not None:
+            return blockers
+        started = time.perf_counter()
+        blockers = set(decode_members(self.client.smembers(get_user_blocked_by_key(user_id))))
+        self.metrics.observe("redis.smembers", time.perf_counter() - started)
+        self._blockers.set(user_id, blockers)
+        return blockers
+
+    def after_batch(self, callback: Callable[[], Any]) -> None:
+        """Run callback once the active batch has executed, or now if there is none"""
+        batch = _active_batch.get()
+        if batch is not None:
+            batch.after(callback)
+        else:
+            callback()
+
+    def drop_blockers(self, user_id: str) -> None:
+        self.invalidate("blockers", user_id)
+
+    def invalidate(self, cache: str, key: str) -> None:
+        """Drop key from the named cache here and on other processes, once the
+        write that changed it has been sent"""
+        def drop():
+            self._caches[cache].drop(key)
+            self.client.publish(INVALIDATION_CHANNEL, f"{cache}:{key}")
+        self.after_batch(drop)
+
+    async def watch_invalidations(self, retry_delay: float = 1.0) -> None:
+        """Drop cache entries that other processes invalidate; runs until cancelled"""
+        while True:
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                while True:
+                    message = await asyncio.to_thread(pubsub.get_message, timeout=1.0)
+                    if message:
+                        cache, _, key = decode(message["data"]).partition(":")
+                        if cache in self._caches:
+                            self._caches[cache].drop(key)
+            except redis.RedisError:
+                # Invalidations may have been missed while disconnected
+                for entries in self._caches.values():
+                    entries.clear()
+                self.metrics.incr("repository.invalidation_errors")
+            finally:
+                pubsub.close()
+            await asyncio.sleep(retry_delay)
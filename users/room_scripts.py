@@ -0,0 +1,175 @@
+"""Server-side Lua scripts for multi-key room mutations.
+
+Each script runs as a single atomic EVALSHA, so membership checks and the
+writes that depend on them cannot interleave with concurrent requests.
+Scripts bump the ETag counter of every key they change by incrementing
+"version:" .. key, matching get_version_key() in users_api.
+
+Per-member keys such as user:{id}:rooms, user:{id}:activity and the unread
+counters are derived inside the scripts from room membership, which assumes
+a single (non-cluster) Redis instance. New messages are the exception: their
+per-member fan-out runs outside Lua in chunks (see fan_out_room_activity in
+users_api), so posting to a large room never blocks Redis for O(members).
+"""
+import redis
+
+# KEYS: room hash, room users, room admins, then one user rooms set per member
+# ARGV: room id, field count, field/value pairs..., member ids (same order as KEYS[4..]),
+#       activity score
+CREATE_ROOM = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+local field_count = tonumber(ARGV[2])
+redis.call('HSET', KEYS[1], unpack(ARGV, 3, 2 + field_count * 2))
+local first_member = 3 + field_count * 2
+local score = ARGV[#ARGV]
+for i = 4, #KEYS do
+    local member = ARGV[first_member + i - 4]
+    redis.call('SADD', KEYS[2], member)
+    redis.call('SADD', KEYS[3], member)
+    redis.call('SADD', KEYS[i], ARGV[1])
+    redis.call('ZADD', 'user:' .. member .. ':activity', 'NX', score, ARGV[1])
+    redis.call('INCR', 'version:' .. KEYS[i])
+end
+redis.call('INCR', 'version:rooms')
+redis.call('INCR', 'version:' .. KEYS[2])
+return 1
+"""
+
+# KEYS: room hash, room users, user rooms, user activity
+# ARGV: user id, room id, "1" to require public-or-member access, activity score
+ADD_MEMBER = """
+if ARGV[3] == '1' then
+    local is_public = redis.call('HGET', KEYS[1], 'is_public')
+    if is_public ~= '1' and redis.call('SISMEMBER', KEYS[2], ARGV[1]) == 0 then
+        return 0
+    end
+end
+redis.call('SADD', KEYS[2], ARGV[1])
+redis.call('SADD', KEYS[3], ARGV[2])
+redis.call('ZADD', KEYS[4], 'NX', ARGV[4], ARGV[2])
+redis.call('INCR', 'version:' .. KEYS[2])
+redis.call('INCR', 'version:' .. KEYS[3])
+return 1
+"""
+
+# KEYS: room admins, room users, member rooms, member activity
+# ARGV: requester id, member id, room id
+REMOVE_MEMBER = """
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('SREM', KEYS[2], ARGV[2])
+redis.call('SREM', KEYS[3], ARGV[3])
+redis.call('SREM', KEYS[1], ARGV[2])
+redis.call('ZREM', KEYS[4], ARGV[3])
+for _, suffix in ipairs({':read', ':unread', ':mentions'}) do
+    redis.call('HDEL', 'user:' .. ARGV[2] .. suffix, ARGV[3])
+end
+redis.call('INCR', 'version:' .. KEYS[2])
+redis.call('INCR', 'version:' .. KEYS[3])
+return 1
+"""
+
+# KEYS: room hash, room users, room admins, then any other per-room keys to drop
+# ARGV: room id, requester id ("" skips the membership check)
+DELETE_ROOM = """
+if ARGV[2] ~= '' and redis.call('SISMEMBER', KEYS[2], ARGV[2]) == 0 then
+    return 0
+end
+for _, member in ipairs(redis.call('SMEMBERS', KEYS[2])) do
+    local member_rooms = 'user:' .. member .. ':rooms'
+    redis.call('SREM', member_rooms, ARGV[1])
+    redis.call('ZREM', 'user:' .. member .. ':activity', ARGV[1])
+    for _, suffix in ipairs({':read', ':unread', ':mentions'}) do
+        redis.call('HDEL', 'user:' .. member .. suffix, ARGV[1])
+    end
+    redis.call('INCR', 'version:' .. member_rooms)
+end
+redis.call('DEL', unpack(KEYS))
+redis.call('INCR', 'version:rooms')
+redis.call('INCR', 'version:' .. KEYS[2])
+return 1
+"""
+
+# KEYS: room admins, room users
+# ARGV: requester id, member id
+PROMOTE_ADMIN = """
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+if redis.call('SISMEMBER', KEYS[2], ARGV[2]) == 0 then
+    return -1
+end
+redis.call('SADD', KEYS[1], ARGV[2])
+return 1
+"""
+
+# KEYS: room admins
+# ARGV: requester id, member id
+DEMOTE_ADMIN = """
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('SREM', KEYS[1], ARGV[2])
+return 1
+"""
+
+# KEYS: room summary
+# ARGV: room id, activity score, sender id, message id, summary field/value pairs...
+RECORD_ACTIVITY = """
+redis.call('HSET', KEYS[1], unpack(ARGV, 5))
+if ARGV[3] ~= '' then
+    local sender = 'user:' .. ARGV[3]
+    redis.call('ZADD', sender .. ':activity', ARGV[2], ARGV[1])
+    redis.call('HSET', sender .. ':read', ARGV[1], ARGV[4])
+    redis.call('HDEL', sender .. ':unread', ARGV[1])
+    redis.call('HDEL', sender .. ':mentions', ARGV[1])
+end
+return 1
+"""
+
+# KEYS: member unread, member mentions
+# ARGV: room id, "1" if the member was mentioned
+# Undoes one message's increments without letting a counter go below zero
+RETRACT_UNREAD = """
+local function decrement(key)
+    local count = tonumber(redis.call('HGET', key, ARGV[1]) or '0')
+    if count <= 1 then
+        redis.call('HDEL', key, ARGV[1])
+    else
+        redis.call('HINCRBY', key, ARGV[1], -1)
+    end
+end
+decrement(KEYS[1])
+if ARGV[2] == '1' then
+    decrement(KEYS[2])
+end
+return 1
+"""
+
+# KEYS: room summary
+# ARGV: message id, field/value pairs... (applied only if it is still the latest message)
+UPDATE_SUMMARY = """
+if redis.call('HGET', KEYS[1], 'message_id') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+return 1
+"""
+
+
+class RoomScripts:
+    """Registered room scripts; redis-py runs them via EVALSHA and reloads on NOSCRIPT."""
+
+    def __init__(self, client: redis.Redis):
+        self.create_room = client.register_script(CREATE_ROOM)
+        self.add_member = client.register_script(ADD_MEMBER)
+        self.remove_member = client.register_script(REMOVE_MEMBER)
+        self.delete_room = client.register_script(DELETE_ROOM)
+        self.promote_admin = client.register_script(PROMOTE_ADMIN)
+        self.demote_admin = client.register_script(DEMOTE_ADMIN)
+        self.record_activity = client.register_script(RECORD_ACTIVITY)
+        self.retract_unread = client.register_script(RETRACT_UNREAD)
+        self.update_summary = client.register_script(UPDATE_SUMMARY)
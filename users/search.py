@@ -0,0 +1,61 @@
+"""Tokenizing and ranking for per-room message search.
+
+The inverted index itself lives in Redis (see SearchStore in repository.py):
+one sorted set per room and term, mapping message ids to the term's weight
+in that message. A query sums its terms' sets weighted by inverse document
+frequency, so rarer terms and messages matching more terms rank higher.
+"""
+import math
+import re
+from collections import Counter
+from typing import Dict, List
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+MAX_TOKEN_LENGTH = 40
+MAX_QUERY_TERMS = 8
+
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have i if in is it its of on or "
+    "so that the this to was we were will with you".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return [
+        token
+        for token in TOKEN_PATTERN.findall(text.lower())
+        if len(token) > 1 and len(token) <= MAX_TOKEN_LENGTH and token not in STOPWORDS
+    ]
+
+
+def term_weights(text: str) -> Dict[str, float]:
+    """Term frequency of each term, damped and normalized by message length"""
+    counts = Counter(tokenize(text))
+    if not counts:
+        return {}
+    length = sum(counts.values())
+    return {
+        term: (1 + math.log(count)) / math.sqrt(length)
+        for term, count in counts.items()
+    }
+
+
+def query_terms(query: str) -> List[str]:
+    return list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+
+
+def idf(document_count: int, term_count: int) -> float:
+    return math.log(1 + document_count / (1 + term_count))
+
+
+def snippet(text: str, terms: List[str], width: int = 160) -> str:
+    """Window of text around the first matching term"""
+    lowered = text.lower()
+    positions = [lowered.find(term) for term in terms if lowered.find(term) >= 0]
+    start = max(min(positions) - width // 4, 0) if positions else 0
+    excerpt = text[start:start + width]
+    if start > 0:
+        excerpt = "…" + excerpt
+    if start + width < len(text):
+        excerpt += "…"
+    return excerpt
@@ -1,4 +1,4 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Request, WebSocket, WebSocketDisconnect, UploadFile, File
+from fastapi import FastAPI, Depends, HTTPException, status, Request, WebSocket, WebSocketDisconnect, UploadFile, File, Query
 from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
 import os
 import uuid
@@ -8,14 +8,57 @@ import io
 import keycloak
 from PIL import Image
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.websockets import WebSocketState
+from fastapi.responses import FileResponse, ORJSONResponse, Response, StreamingResponse
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional, List, Dict, Union, Any
 from datetime import datetime, timezone
 import requests
 import json
+import hashlib
 import base64
+import zipfile
+import re
+import hmac
+import signal
 import redis
 import keycloak 
+import avatars
+from compression import CompressionMiddleware
+from room_scripts import RoomScripts
+from connections import Connection, ConnectionManager, format_sse
+from dispatch import DispatchQueue
+from search import idf, query_terms, snippet, term_weights
+from write_behind import WriteBehindBuffer
+from ws_codecs import decode_frame, negotiate
+from metrics import metrics
+from repository import (
+    Repository,
+    get_admins_key,
+    get_attachment_key,
+    get_attachment_rooms_key,
+    get_attachment_uploaders_key,
+    get_messages_key,
+    get_notifications_key,
+    get_orgs_key,
+    get_payload_rooms_key,
+    get_pubsub_key,
+    get_reports_key,
+    get_room_events_key,
+    get_room_key,
+    get_room_payload_refs_key,
+    get_room_payloads_key,
+    get_room_summary_key,
+    get_room_timeline_backfilled_key,
+    get_room_timeline_key,
+    get_upload_key,
+    get_user_activity_key,
+    get_user_key,
+    get_user_mentions_key,
+    get_user_rooms_key,
+    get_user_unread_key,
+    get_users_key,
+)
+from blobstore import BlobStore, hash_bytes, hash_file, is_valid_hash
 
 # Add parent directory to sys.path 
 import sys
@@ -33,13 +76,55 @@ from env import (
 current_dir = os.path.dirname(os.path.abspath(__file__))
 
 # FastAPI app setup
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 app.add_middleware(ProxyHeadersMiddleware, trusted_hosts="*")
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=int(os.getenv("COMPRESSION_MIN_BYTES", "1024")),
+    gzip_level=int(os.getenv("GZIP_LEVEL", "6")),
+    brotli_quality=int(os.getenv("BROTLI_QUALITY", "5")),
+)
 # Security scheme for JWT tokens
 security = HTTPBearer()
+# For endpoints that also serve anonymous viewers
+optional_security = HTTPBearer(auto_error=False)
 
 # Redis setup
 redis_client = redis.Redis(host='redis_messaging', port=6379, db=0, password=REDIS_PASSWORD)
+room_scripts = RoomScripts(redis_client)
+repo = Repository(
+    redis_client,
+    metrics,
+    cache_ttl=float(os.getenv("PROFILE_CACHE_TTL", "5")),
+    blockers_ttl=float(os.getenv("BLOCKERS_CACHE_TTL", "30")),
+    cache_size=int(os.getenv("REPOSITORY_CACHE_SIZE", "10000")),
+)
+
+# Content-addressed media storage
+BLOB_DIR = os.getenv("USERS_BLOB_DIR", os.path.join(current_dir, "blobs"))
+MAX_AVATAR_BYTES = int(os.getenv("MAX_AVATAR_BYTES", str(10 * 1024 * 1024)))
+AVATAR_WORKERS = int(os.getenv("AVATAR_WORKERS", "2"))
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+MAX_ATTACHMENT_BYTES = int(os.getenv("MAX_ATTACHMENT_BYTES", str(100 * 1024 * 1024)))
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", str(24 * 60 * 60)))
+UPLOAD_SWEEP_INTERVAL = float(os.getenv("UPLOAD_SWEEP_INTERVAL", "3600"))
+STREAM_CHUNK_BYTES = 256 * 1024
+INLINE_PAYLOAD_LIMIT = int(os.getenv("INLINE_PAYLOAD_LIMIT", "4096"))
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", "100"))
+MAX_LIST_PAGE_SIZE = int(os.getenv("MAX_LIST_PAGE_SIZE", "500"))
+ROOM_SIDEBAR_FIELDS = ["name", "is_public"]
+ORG_SIDEBAR_FIELDS = ["name", "slug", "url"]
+MESSAGE_PREVIEW_CHARS = int(os.getenv("MESSAGE_PREVIEW_CHARS", "140"))
+MENTION_INBOX_LENGTH = int(os.getenv("MENTION_INBOX_LENGTH", "1000"))
+MENTION_PATTERN = re.compile(r"@([0-9a-fA-F]{8}-[0-9a-fA-F-]{27})")
+avatar_store = BlobStore(os.path.join(BLOB_DIR, "avatars"))
+attachment_store = BlobStore(os.path.join(BLOB_DIR, "attachments"))
+payload_store = BlobStore(os.path.join(BLOB_DIR, "payloads"))
+UPLOADS_DIR = os.path.join(BLOB_DIR, "uploads")
+os.makedirs(UPLOADS_DIR, exist_ok=True)
+avatar_pool: Optional[ProcessPoolExecutor] = None
+upload_sweeper: Optional[asyncio.Task] = None
+invalidation_watcher: Optional[asyncio.Task] = None
 
 # JWT Authentication with python-jose
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
@@ -51,37 +136,51 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
 messages_all_languages: List[Dict] = []
 messages_by_language = {}
 
-class ConnectionManager:
-    def __init__(self):
-        self.client_connections: Dict[str, WebSocket] = {}
-
-    async def connect(self, websocket: WebSocket, client_id: str):
-        print(f"Client {client_id} connected")
-        self.client_connections[client_id] = websocket
-
-    def disconnect(self, client_id: str):
-        if client_id in self.client_connections:
-            self.client_connections.pop(client_id, None)
-
-    async def broadcast(self, room_id: str, message: Dict):
-        # Get all users in this room from Redis
-        room_users_key = f"room:{room_id}:users"
-        user_ids = [uid.decode() for uid in redis_client.smembers(room_users_key)]
-        print(f"Broadcasting message to room {room_id} users: {user_ids}")
-        print(f"Current connections: {self.client_connections.keys()}")
-        
-        # Send message to all connected users in the room
-        for user_id in user_ids:
-            if user_id in self.client_connections:
-                websocket = self.client_connections[user_id]
-                if websocket.client_state == WebSocketState.CONNECTED:
-                    try:
-                        await websocket.send_json(message)
-                    except WebSocketDisconnect:
-                        self.disconnect(user_id)
-
-
-manager = ConnectionManager()
+# Presence keys outlive a couple of missed heartbeats before users show as offline
+PRESENCE_TTL = int(os.getenv("PRESENCE_TTL", "60"))
+
+manager = ConnectionManager(
+    metrics,
+    member_ids=lambda room_id: repo.rooms.member_ids(room_id),
+    blockers=repo.blockers,
+    presence=lambda user_ids: repo.presence.touch(user_ids, PRESENCE_TTL),
+    heartbeat_interval=float(os.getenv("WS_HEARTBEAT_INTERVAL", "25")),
+    heartbeat_timeout=float(os.getenv("WS_HEARTBEAT_TIMEOUT", "60")),
+    send_timeout=float(os.getenv("WS_SEND_TIMEOUT", "5")),
+    max_connections=int(os.getenv("WS_MAX_CONNECTIONS", "10000")),
+    max_connections_per_user=int(os.getenv("WS_MAX_CONNECTIONS_PER_USER", "5")),
+    max_viewer_queue=int(os.getenv("SSE_QUEUE_SIZE", "100")),
+    # Coalesce each room's broadcasts over a few milliseconds into batch frames; 0 disables
+    coalesce_window=float(os.getenv("WS_COALESCE_MS", "0")) / 1000,
+    coalesce_max_batch=int(os.getenv("WS_COALESCE_MAX_BATCH", "50")),
+    typing_window=float(os.getenv("TYPING_WINDOW_MS", "250")) / 1000,
+    typing_interval=float(os.getenv("TYPING_MIN_INTERVAL", "2")),
+)
+BLOCKED_BY_MIGRATION_KEY = "migrations:blocked_by"
+# Seconds a search's ranked results are kept for paging through them
+SEARCH_RESULTS_TTL = int(os.getenv("SEARCH_RESULTS_TTL", "30"))
+
+# Room fan-out runs on background workers so senders don't wait on delivery
+dispatcher = DispatchQueue(
+    metrics,
+    workers=int(os.getenv("DISPATCH_WORKERS", "4")),
+    max_size=int(os.getenv("DISPATCH_QUEUE_SIZE", "1000")),
+)
+# Optionally gather new messages' writes for a few milliseconds into one pipeline
+write_buffer = WriteBehindBuffer(
+    repo,
+    metrics,
+    window=float(os.getenv("MESSAGE_WRITE_BEHIND_MS", "0")) / 1000,
+    max_batch=int(os.getenv("MESSAGE_WRITE_BEHIND_BATCH", "100")),
+)
+# Members updated per pipeline when a message bumps a room's activity and unread counts
+ACTIVITY_FANOUT_CHUNK = int(os.getenv("ACTIVITY_FANOUT_CHUNK", "500"))
+SSE_REPLAY_LENGTH = int(os.getenv("SSE_REPLAY_LENGTH", "1000"))
+SSE_KEEPALIVE = float(os.getenv("SSE_KEEPALIVE", "15"))
+WS_DRAIN_WINDOW = float(os.getenv("WS_DRAIN_WINDOW", "8"))
+WS_DRAIN_BATCH_SIZE = int(os.getenv("WS_DRAIN_BATCH_SIZE", "100"))
+WS_RECONNECT_JITTER = float(os.getenv("WS_RECONNECT_JITTER", "10"))
+ADMIN_TOKEN = os.getenv("USERS_ADMIN_TOKEN", "")
 
 async def translate_message_async(
     session: aiohttp.ClientSession,
@@ -113,6 +212,20 @@ async def translate_message_async(
 # Fetch LibreTranslate languages on startup
 @app.on_event("startup")
 async def startup_event():
+    global upload_sweeper, invalidation_watcher
+    manager.start()
+    dispatcher.start()
+    upload_sweeper = asyncio.create_task(sweep_uploads())
+    invalidation_watcher = asyncio.create_task(repo.watch_invalidations())
+    backfill_blocked_by()
+    # Drain sockets before exiting on SIGTERM; replaces uvicorn's handler, which
+    # would drop every socket at once
+    try:
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, lambda: asyncio.ensure_future(drain_and_exit())
+        )
+    except (NotImplementedError, RuntimeError, ValueError):
+        pass
     # Initialize message languages
     try:
         response = requests.get("http://libretranslate:5000/languages")
@@ -124,15 +237,49 @@ async def startup_event():
     except Exception as e:
         print(f"Failed to fetch LibreTranslate languages: {e}")
 
-def get_user_key(uuid: str) -> str:
-    return f"user:{uuid}"
+@app.on_event("shutdown")
+async def shutdown_event():
+    write_buffer.flush()
+    await dispatcher.stop()
+    await manager.stop()
+    if upload_sweeper is not None:
+        upload_sweeper.cancel()
+    if invalidation_watcher is not None:
+        invalidation_watcher.cancel()
+    if avatar_pool is not None:
+        avatar_pool.shutdown(wait=False, cancel_futures=True)
+
+def backfill_blocked_by() -> None:
+    """Build the reverse block index for blocks recorded before it existed (runs once)"""
+    if redis_client.exists(BLOCKED_BY_MIGRATION_KEY):
+        return
+    for key in redis_client.scan_iter("user:*:blocked"):
+        user_id = key.decode("utf-8").split(":")[1]
+        target_ids = repo.users.blocked_ids(user_id)
+        with repo.batch():
+            for target_id in target_ids:
+                repo.users.block(user_id, target_id)
+    redis_client.set(BLOCKED_BY_MIGRATION_KEY, 1)
+
+def start_drain() -> asyncio.Task:
+    return manager.start_drain(WS_DRAIN_WINDOW, WS_DRAIN_BATCH_SIZE, WS_RECONNECT_JITTER)
+
+async def drain_and_exit():
+    await start_drain()
+    # Hand over to uvicorn's SIGINT handler for the normal graceful shutdown
+    os.kill(os.getpid(), signal.SIGINT)
+
+def get_avatar_pool() -> ProcessPoolExecutor:
+    global avatar_pool
+    if avatar_pool is None:
+        avatar_pool = ProcessPoolExecutor(max_workers=AVATAR_WORKERS)
+    return avatar_pool
 
 def sync_profile_from_token(payload: Dict[str, Any]) -> None:
     user_id = payload.get("sub")
     if not user_id:
         return
-    user_key = get_user_key(user_id)
-    if redis_client.exists(user_key):
+    if repo.users.exists(user_id):
         return
 
     given = (payload.get("given_name") or "").strip()
@@ -154,10 +301,8 @@ def sync_profile_from_token(payload: Dict[str, Any]) -> None:
     if picture:
         profile["picture"] = picture
 
-    redis_client.hset(user_key, mapping=profile)
-
-def get_notifications_key(user_id: str) -> str:
-    return f"user:{user_id}:notifications"
+    repo.users.save(user_id, profile)
+    bump_versions(get_user_key(user_id), "profiles")
 
 def add_notification(user_id: str, payload: Dict[str, Any]) -> Dict[str, Any]:
     notification_id = str(uuid.uuid4())
@@ -166,11 +311,8 @@ def add_notification(user_id: str, payload: Dict[str, Any]) -> Dict[str, Any]:
         "id": notification_id,
         "timestamp": datetime.now(timezone.utc).isoformat()
     }
-    redis_client.hset(
-        get_notifications_key(user_id),
-        notification_id,
-        json.dumps(notification)
-    )
+    repo.notifications.add(user_id, notification)
+    bump_versions(get_notifications_key(user_id))
     return notification
 
 def get_keycloak_admin_token() -> str:
@@ -196,18 +338,16 @@ def get_keycloak_admin_token() -> str:
         )
     return token
 
-def get_profile_summary(user_uuid: str) -> Dict[str, Optional[str]]:
-    user_key = get_user_key(user_uuid)
-    user_data = redis_client.hgetall(user_key)
-    if not user_data:
+def build_profile_summary(user_uuid: str, profile_data: Dict[str, str]) -> Dict[str, Optional[str]]:
+    if not profile_data:
         return {
             "uuid": user_uuid,
             "name": "[deleted]",
             "display_name": "[deleted]",
-            "picture": None
+            "picture": None,
+            "avatar": None
         }
 
-    profile_data = {k.decode(): v.decode() for k, v in user_data.items()}
     display_name = (
         profile_data.get("display_name")
         or profile_data.get("name")
@@ -218,7 +358,8 @@ def get_profile_summary(user_uuid: str) -> Dict[str, Optional[str]]:
         "uuid": user_uuid,
         "name": profile_data.get("name"),
         "display_name": display_name,
-        "picture": profile_data.get("picture")
+        "picture": profile_data.get("picture"),
+        "avatar": profile_data.get("avatar")
     }
 
 @app.post("/users/", response_model=Dict)
@@ -232,8 +373,8 @@ def create_user(
     
     # Ensure UUID is set in user data
     user["uuid"] = uuid
-    user_key = get_user_key(uuid)
-    redis_client.hset(user_key, mapping=user)
+    repo.users.save(uuid, user)
+    bump_versions(get_user_key(uuid), "profiles")
     return user
 
 @app.get("/users/{uuid}", response_model=Dict)
@@ -241,13 +382,9 @@ def read_user(
     uuid: str,
     current_user: dict = Depends(get_current_user)
 ):
-    user_key = get_user_key(uuid)
-    user_data = redis_client.hgetall(user_key)
-    if not user_data:
+    user_dict = repo.users.get(uuid)
+    if not user_dict:
         raise HTTPException(status_code=404, detail="User not found")
-    
-    # Convert bytes to strings
-    user_dict = {k.decode(): v.decode() for k, v in user_data.items()}
     return user_dict
 
 @app.put("/profile")
@@ -259,8 +396,6 @@ async def update_user(
     if not uuid:
         raise HTTPException(status_code=400, detail="Invalid token: missing user ID")
 
-    user_key = get_user_key(uuid)
-    
     # Ensure UUID is included in the stored data
     user_data['uuid'] = uuid
     
@@ -268,7 +403,8 @@ async def update_user(
     filtered_data = {k: v for k, v in user_data.items() if v is not None}
     
     # Update or create the profile
-    redis_client.hset(user_key, mapping=filtered_data)
+    repo.users.save(uuid, filtered_data)
+    bump_versions(get_user_key(uuid), "profiles")
     
     return {"message": "Profile updated successfully"}
 
@@ -281,16 +417,14 @@ async def get_current_user_profile(
     if not user_uuid:
         raise HTTPException(status_code=400, detail="User UUID required")
 
-    user_key = get_user_key(user_uuid)
-    user_data = redis_client.hgetall(user_key)
-    profile_data = {k.decode(): v.decode() for k, v in user_data.items()} if user_data else {}
-
     # Return all profile fields for own profile
-    return profile_data
+    return repo.users.get(user_uuid)
 
 @app.get("/profile/{user_uuid}")
 async def get_profile_by_uuid(
     user_uuid: str,
+    request: Request,
+    response: Response,
     current_user: dict = Depends(get_current_user)
 ):
     """Get profile information for any user by their UUID"""
@@ -298,22 +432,25 @@ async def get_profile_by_uuid(
         raise HTTPException(status_code=400, detail="User UUID required")
 
     user_key = get_user_key(user_uuid)
-    user_data = redis_client.hgetall(user_key)
-    if not user_data:
+    not_modified = check_not_modified(request, response, user_key)
+    if not_modified:
+        return not_modified
+
+    profile_data = repo.users.get(user_uuid)
+    if not profile_data:
         return {
             "uuid": user_uuid,
             "name": "[deleted]",
             "display_name": "[deleted]",
             "bio": None,
-            "picture": None
+            "picture": None,
+            "avatar": None
         }
 
-    profile_data = {k.decode(): v.decode() for k, v in user_data.items()}
-
-    # Get default image if no picture set
+    # Get default image if no picture or uploaded avatar is set
     default_image_path = os.path.join(current_dir, "..", "webapp", "public", "assets", "dummy-image.jpg")
     picture = profile_data.get("picture")
-    if not picture and os.path.exists(default_image_path):
+    if not picture and not profile_data.get("avatar") and os.path.exists(default_image_path):
         with open(default_image_path, "rb") as image_file:
             picture = base64.b64encode(image_file.read()).decode("utf-8")
         profile_data["picture"] = picture
@@ -330,9 +467,74 @@ async def get_profile_by_uuid(
         "name": profile_data.get("name"),
         "display_name": display_name,
         "bio": profile_data.get("bio"),
-        "picture": profile_data.get("picture")
+        "picture": profile_data.get("picture"),
+        "avatar": profile_data.get("avatar")
     }
 
+@app.post("/profile/avatar")
+async def upload_avatar(
+    file: UploadFile = File(...),
+    current_user: dict = Depends(get_current_user)
+):
+    """Upload a profile picture and store fixed-size thumbnails by content hash"""
+    user_uuid = current_user.get("sub")
+    if not user_uuid:
+        raise HTTPException(status_code=400, detail="Invalid token: missing user ID")
+
+    data = await file.read(MAX_AVATAR_BYTES + 1)
+    if not data:
+        raise HTTPException(status_code=400, detail="Empty image upload")
+    if len(data) > MAX_AVATAR_BYTES:
+        raise HTTPException(status_code=413, detail="Image too large")
+
+    avatar_hash = hash_bytes(data)
+    expected = [
+        f"{size}.{extension}"
+        for size in avatars.AVATAR_SIZES
+        for extension in avatars.AVATAR_FORMATS
+    ]
+    if not all(avatar_store.exists(avatar_hash, name) for name in expected):
+        loop = asyncio.get_running_loop()
+        try:
+            thumbnails = await loop.run_in_executor(
+                get_avatar_pool(), avatars.render_thumbnails, data
+            )
+        except Exception as exc:
+            raise HTTPException(status_code=400, detail="Invalid image") from exc
+        for name, thumbnail in thumbnails.items():
+            avatar_store.put(avatar_hash, thumbnail, name)
+
+    with repo.batch():
+        repo.users.save(user_uuid, {"uuid": user_uuid, "avatar": avatar_hash})
+        # The inline picture is superseded by the avatar hash
+        repo.users.remove_fields(user_uuid, "picture")
+    bump_versions(get_user_key(user_uuid), "profiles")
+
+    return {"avatar": avatar_hash, "sizes": list(avatars.AVATAR_SIZES)}
+
+@app.get("/avatars/{avatar_hash}/{size}.{extension}")
+async def get_avatar(avatar_hash: str, size: int, extension: str):
+    """Serve an avatar thumbnail; content is addressed by hash so it never changes"""
+    if (
+        not is_valid_hash(avatar_hash)
+        or size not in avatars.AVATAR_SIZES
+        or extension not in avatars.AVATAR_FORMATS
+    ):
+        raise HTTPException(status_code=404, detail="Avatar not found")
+
+    name = f"{size}.{extension}"
+    if not avatar_store.exists(avatar_hash, name):
+        raise HTTPException(status_code=404, detail="Avatar not found")
+
+    return FileResponse(
+        avatar_store.path_for(avatar_hash, name),
+        media_type=avatars.AVATAR_FORMATS[extension][1],
+        headers={
+            "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+            "ETag": f'"{avatar_hash}-{name}"',
+        },
+    )
+
 @app.delete("/users/{uuid}")
 async def delete_user(
     uuid: str,
@@ -361,40 +563,35 @@ async def delete_user(
     user_key = get_user_key(uuid)
     notifications_key = get_notifications_key(uuid)
     user_rooms_key = get_user_rooms_key(uuid)
-    user_blocks_key = get_user_blocks_key(uuid)
-    room_ids = [room_id.decode() for room_id in redis_client.smembers(user_rooms_key)]
-
-    for room_id in room_ids:
-        room_key = get_room_key(room_id)
-        room_data = redis_client.hgetall(room_key)
-        is_public = room_data.get(b"is_public", b"0") == b"1" if room_data else False
-        is_dm = "_" in room_id
-
-        if is_dm or not is_public:
-            member_ids = redis_client.smembers(get_users_key(room_id))
-            for member in member_ids:
-                member_id = member.decode()
-                redis_client.srem(get_user_rooms_key(member_id), room_id)
-
-            redis_client.delete(
-                room_key,
-                get_users_key(room_id),
-                get_admins_key(room_id),
-                f"room:{room_id}:messages",
-                get_pubsub_key(room_id),
-            )
-        else:
-            redis_client.srem(get_users_key(room_id), uuid)
-            redis_client.srem(get_admins_key(room_id), uuid)
-            redis_client.srem(user_rooms_key, room_id)
-
-    redis_client.delete(user_rooms_key)
-    redis_client.delete(user_key)
-    redis_client.delete(notifications_key)
-    redis_client.delete(user_blocks_key)
-
-    for key in redis_client.scan_iter("user:*:blocked"):
-        redis_client.srem(key, uuid)
+    rooms = repo.rooms.get_many(repo.users.room_ids(uuid))
+    changed_resources = {user_key, notifications_key, user_rooms_key, "profiles", "rooms"}
+
+    with repo.batch():
+        for room_id, room_data in rooms.items():
+            is_public = room_data.get("is_public", "0") == "1"
+            is_dm = "_" in room_id
+            changed_resources.add(get_users_key(room_id))
+
+            if not is_dm and is_public:
+                repo.rooms.remove_member(room_id, uuid)
+
+    # Private rooms and DMs go away entirely, each in one atomic script
+    for room_id, room_data in rooms.items():
+        if "_" in room_id or room_data.get("is_public", "0") != "1":
+            delete_room_record(room_id)
+
+    # Unlink the user from both sides of every block via the reverse index
+    with repo.batch():
+        blocked = repo.users.blocked_ids(uuid)
+        blocked_by = repo.users.blocked_by_ids(uuid)
+    with repo.batch():
+        for target_id in blocked.value:
+            repo.users.unblock(uuid, target_id)
+        for blocker_id in blocked_by.value:
+            repo.users.unblock(blocker_id, uuid)
+
+    repo.users.delete(uuid)
+    bump_versions(*changed_resources)
 
     reports_key = get_reports_key()
     if redis_client.exists(reports_key):
@@ -427,7 +624,7 @@ async def block_user(
     if requester_id == target_id:
         raise HTTPException(status_code=400, detail="Cannot block yourself")
 
-    redis_client.sadd(get_user_blocks_key(requester_id), target_id)
+    repo.users.block(requester_id, target_id)
     return {"status": "blocked"}
 
 @app.delete("/users/{target_id}/block")
@@ -441,7 +638,7 @@ async def unblock_user(
     if requester_id == target_id:
         raise HTTPException(status_code=400, detail="Cannot unblock yourself")
 
-    redis_client.srem(get_user_blocks_key(requester_id), target_id)
+    repo.users.unblock(requester_id, target_id)
     return {"status": "unblocked"}
 
 @app.post("/users/{target_id}/report")
@@ -472,6 +669,7 @@ async def list_people(current_user: dict = Depends(get_current_user)):
     """Return a list of all user profiles for discovery."""
     people = []
     try:
+        user_uuids = []
         for key in redis_client.scan_iter("user:*"):
             key_str = key.decode()
             if key_str.endswith(":rooms"):
@@ -479,18 +677,17 @@ async def list_people(current_user: dict = Depends(get_current_user)):
             # Skip nested keys like user:{id}:something
             if key_str.count(":") != 1:
                 continue
+            user_uuids.append(key_str.split(":")[1])
 
-            user_uuid = key_str.split(":")[1]
-            user_data = redis_client.hgetall(key)
-            if not user_data:
+        for user_uuid, profile_data in repo.users.get_many(user_uuids).items():
+            if not profile_data:
                 profile_data = {
                     "name": user_uuid,
                     "display_name": user_uuid,
                     "bio": "",
-                    "picture": None
+                    "picture": None,
+                    "avatar": None
                 }
-            else:
-                profile_data = {k.decode(): v.decode() for k, v in user_data.items()}
             display_name = (
                 profile_data.get("display_name")
                 or profile_data.get("name")
@@ -501,52 +698,309 @@ async def list_people(current_user: dict = Depends(get_current_user)):
                 "name": profile_data.get("name"),
                 "display_name": display_name,
                 "bio": profile_data.get("bio"),
-                "picture": profile_data.get("picture")
+                "picture": profile_data.get("picture"),
+                "avatar": profile_data.get("avatar")
             })
     except Exception as exc:
         raise HTTPException(status_code=500, detail="Failed to fetch people") from exc
 
-    return {"people": people}
-
-def get_room_key(room_id: str) -> str:
-    return f"room:{room_id}"
-
-def get_users_key(room_id: str) -> str:
-    return f"room:{room_id}:users"
-
-def get_admins_key(room_id: str) -> str:
-    return f"room:{room_id}:admins"
-
-def get_user_rooms_key(user_id: str) -> str:
-    return f"user:{user_id}:rooms"
+    # Returned directly so large listings skip jsonable_encoder
+    return ORJSONResponse({"people": people})
 
-def get_orgs_key() -> str:
-    return "orgs"
+def bump_versions(*resources: str) -> None:
+    """Invalidate cached reads of the given resources"""
+    repo.versions.bump(*resources)
 
-def get_org_key(org_id: str) -> str:
-    return f"org:{org_id}"
+def get_etag(*resources: str) -> str:
+    versions = repo.versions.get(*resources)
+    state = "|".join(
+        f"{resource}={version or '0'}"
+        for resource, version in zip(resources, versions)
+    )
+    return f'W/"{hashlib.sha1(state.encode()).hexdigest()[:20]}"'
+
+def check_not_modified(request: Request, response: Response, *resources: str) -> Optional[Response]:
+    """Return a 304 if the client's ETag is current, otherwise tag the response"""
+    etag = get_etag(*resources)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("If-None-Match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
 
-def get_org_rooms_key(org_id: str) -> str:
-    return f"org:{org_id}:rooms"
+def paginate_ids(ids: List[str], cursor: Optional[str], limit: Optional[int]):
+    """Page through ids in sorted order; the cursor is the last id of the previous page.
+
+    Without a cursor or limit every id is returned, as before lists were paged.
+    """
+    ordered = sorted(ids)
+    if cursor is None and limit is None:
+        return ordered, None
+    limit = limit or LIST_PAGE_SIZE
+    if cursor:
+        ordered = [item for item in ordered if item > cursor]
+    page = ordered[:limit]
+    next_cursor = page[-1] if len(ordered) > limit else None
+    return page, next_cursor
 
-def get_org_events_key(org_id: str) -> str:
-    return f"org:{org_id}:events"
+def check_room_access(room_id: str, user_id: str) -> bool:
+    """Check if user has access to room (public or invited)"""
+    with repo.batch():
+        is_public = repo.rooms.is_public(room_id)
+        is_member = repo.rooms.is_member(room_id, user_id)
+    return is_public.value or is_member.value
+
+def create_room_record(room_id: str, room_data: Dict[str, Any], members: List[str]) -> bool:
+    """Atomically create a room with the given members as admins; False if it exists"""
+    fields = [item for pair in room_data.items() for item in pair]
+    return bool(room_scripts.create_room(
+        keys=[
+            get_room_key(room_id),
+            get_users_key(room_id),
+            get_admins_key(room_id),
+            *[get_user_rooms_key(member) for member in members],
+        ],
+        args=[room_id, len(room_data), *fields, *members, activity_score()],
+    ))
+
+def delete_room_record(room_id: str, requester_id: str = "") -> bool:
+    """Atomically delete a room and unlink it from every member; False if requester isn't a member"""
+    payload_hashes = redis_client.smembers(get_room_payloads_key(room_id))
+    deleted = bool(room_scripts.delete_room(
+        keys=[
+            get_room_key(room_id),
+            get_users_key(room_id),
+            get_admins_key(room_id),
+            get_messages_key(room_id),
+            get_pubsub_key(room_id),
+            get_room_payloads_key(room_id),
+            get_room_payload_refs_key(room_id),
+            get_room_summary_key(room_id),
+            get_room_events_key(room_id),
+            get_room_timeline_key(room_id),
+            get_room_timeline_backfilled_key(room_id),
+        ],
+        args=[room_id, requester_id],
+    ))
+    if deleted:
+        repo.search.drop(room_id)
+        repo.threads.drop(room_id)
+        drop_room_payloads(room_id, [payload_hash.decode() for payload_hash in payload_hashes])
+    return deleted
+
+def drop_room_payloads(room_id: str, payload_hashes: List[str]) -> None:
+    """Remove the room's claim on its payload blobs, deleting blobs no other room uses"""
+    for payload_hash in payload_hashes:
+        rooms_key = get_payload_rooms_key(payload_hash)
+        redis_client.srem(rooms_key, room_id)
+        if not redis_client.scard(rooms_key) and is_valid_hash(payload_hash):
+            payload_store.delete(payload_hash)
+
+def release_payload(room_id: str, payload: Optional[Dict[str, Any]]) -> None:
+    """Drop one message's reference to a payload, freeing it once no message in the room uses it"""
+    payload_hash = (payload or {}).get("hash")
+    if not payload_hash:
+        return
+    refs_key = get_room_payload_refs_key(room_id)
+    if redis_client.hincrby(refs_key, payload_hash, -1) > 0:
+        return
+    redis_client.hdel(refs_key, payload_hash)
+    redis_client.srem(get_room_payloads_key(room_id), payload_hash)
+    drop_room_payloads(room_id, [payload_hash])
+
+def add_room_member(room_id: str, user_id: str, require_access: bool = False) -> bool:
+    return bool(room_scripts.add_member(
+        keys=[
+            get_room_key(room_id),
+            get_users_key(room_id),
+            get_user_rooms_key(user_id),
+            get_user_activity_key(user_id),
+        ],
+        args=[user_id, room_id, "1" if require_access else "0", activity_score()],
+    ))
 
-def get_pubsub_key(room_id: str) -> str:
-    return f"room:{room_id}:pubsub"
+def activity_score(timestamp: Optional[str] = None) -> float:
+    """Sort score for the room activity index: epoch seconds of an ISO timestamp, or now"""
+    if timestamp:
+        try:
+            return datetime.fromisoformat(timestamp).timestamp()
+        except ValueError:
+            pass
+    return datetime.now(timezone.utc).timestamp()
+
+def get_message_id(message: Dict[str, Any]) -> Optional[str]:
+    content = message.get("content")
+    if message.get("content_uuid"):
+        return message["content_uuid"]
+    if isinstance(content, dict):
+        return content.get("uuid")
+    return None
 
-def get_user_blocks_key(user_id: str) -> str:
-    return f"user:{user_id}:blocked"
+def plaintext_content(content: Any, payload: Optional[Dict[str, Any]] = None) -> Any:
+    """Message content with JSON strings parsed; None for encrypted content"""
+    if payload and payload.get("encoding") == "tdf":
+        return None
+    if isinstance(content, str):
+        trimmed = content.strip()
+        if trimmed.startswith("TDF"):
+            return None
+        try:
+            content = json.loads(trimmed)
+        except json.JSONDecodeError:
+            content = trimmed
+    return content
+
+def message_text(content: Any, payload: Optional[Dict[str, Any]] = None) -> Optional[str]:
+    """Full plaintext of a message; None for encrypted or non-text content"""
+    content = plaintext_content(content, payload)
+    if isinstance(content, dict):
+        content = content.get("text") or ""
+    return content if isinstance(content, str) else None
+
+def build_message_preview(content: Any, payload: Optional[Dict[str, Any]] = None) -> Optional[str]:
+    """Short plaintext preview for room lists; None for encrypted content"""
+    content = plaintext_content(content, payload)
+    if isinstance(content, dict):
+        text = content.get("text") or ""
+        if not text and content.get("attachments"):
+            text = "[attachment]"
+        content = text
+    if not isinstance(content, str):
+        return None
+    return content[:MESSAGE_PREVIEW_CHARS]
+
+def build_room_summary(message: Dict[str, Any]) -> Dict[str, str]:
+    """Fields stored in room:{id}:summary for the latest message"""
+    preview = build_message_preview(message.get("content"), message.get("payload"))
+    return {
+        "message_id": get_message_id(message) or "",
+        "sender": message.get("sender") or "",
+        "timestamp": message.get("timestamp") or "",
+        "preview": preview or "",
+        "encrypted": "1" if preview is None else "0",
+    }
 
-def get_reports_key() -> str:
-    return "reports"
+def extract_mentions(message: Dict[str, Any]) -> List[str]:
+    """User ids mentioned by a message: an explicit mentions list plus @<user id> tokens"""
+    content = message.get("content")
+    mentioned = message.get("mentions")
+    if mentioned is None and isinstance(content, dict):
+        mentioned = content.get("mentions")
+    if mentioned is not None and not isinstance(mentioned, list):
+        raise HTTPException(status_code=400, detail="mentions must be a list")
+    user_ids = [item for item in mentioned or [] if isinstance(item, str)]
+    text = content.get("text") if isinstance(content, dict) else content
+    if isinstance(text, str) and not text.lstrip().startswith("TDF"):
+        user_ids.extend(MENTION_PATTERN.findall(text))
+    return list(dict.fromkeys(user_ids))
+
+def index_message(room_id: str, message: Dict[str, Any]) -> None:
+    """Add a plaintext message to the room's search index; encrypted ones stay out"""
+    message_id = get_message_id(message)
+    text = message_text(message.get("content"), message.get("payload"))
+    if not message_id or not text:
+        return
+    weights = term_weights(text)
+    if weights:
+        repo.search.add(room_id, message_id, {
+            "message_id": message_id,
+            "sender": message.get("sender"),
+            "timestamp": message.get("timestamp"),
+            "text": text,
+        }, weights)
+
+def mention_recipients(room_id: str, sender: str, mentions: List[str]) -> List[str]:
+    """Mentioned users who get an inbox entry: other members of the room who haven't blocked the sender"""
+    candidates = [user_id for user_id in mentions if user_id != sender]
+    if not candidates:
+        return []
+    with repo.batch():
+        membership = {user_id: repo.rooms.is_member(room_id, user_id) for user_id in candidates}
+    blockers = repo.blockers(sender)
+    return [user_id for user_id, is_member in membership.items() if is_member.value and user_id not in blockers]
+
+def record_room_activity(room_id: str, message: Dict[str, Any]) -> None:
+    """Store the room's summary and mark it read and active for the sender; the
+    other members are updated by fan_out_room_activity"""
+    summary = build_room_summary(message)
+    fields = [item for pair in summary.items() for item in pair]
+    repo.run_script(
+        room_scripts.record_activity,
+        keys=[get_room_summary_key(room_id)],
+        args=[
+            room_id,
+            activity_score(message.get("timestamp")),
+            message.get("sender") or "",
+            summary["message_id"],
+            *fields,
+        ],
+    )
 
-def check_room_access(room_id: str, user_id: str) -> bool:
-    """Check if user has access to room (public or invited)"""
-    is_public = redis_client.hget(get_room_key(room_id), "is_public")
-    if is_public and is_public.decode() == "1":
-        return True
-    return redis_client.sismember(get_users_key(room_id), user_id)
+async def retract_room_activity(room_id: str, message: Dict[str, Any]) -> None:
+    """Take a deleted message back out of the unread (and mentions) counts of
+    members whose read marker is older than it, ACTIVITY_FANOUT_CHUNK at a time"""
+    sender = message.get("sender") or ""
+    message_id = get_message_id(message)
+    score = activity_score(message.get("timestamp"))
+    mentions = set(message.get("mentions") or [])
+    member_ids = [member_id for member_id in repo.rooms.member_ids(room_id) if member_id != sender]
+    for start in range(0, len(member_ids), ACTIVITY_FANOUT_CHUNK):
+        chunk = member_ids[start:start + ACTIVITY_FANOUT_CHUNK]
+        with repo.batch():
+            markers = {member_id: repo.unread.marker(member_id, room_id) for member_id in chunk}
+        # Members whose marker is the deleted message itself had read it
+        chunk = [member_id for member_id in chunk if not message_id or markers[member_id].value != message_id]
+        with repo.batch():
+            read_up_to = {
+                member_id: repo.messages.time_score(room_id, markers[member_id].value)
+                for member_id in chunk if markers[member_id].value
+            }
+        with repo.batch():
+            for member_id in chunk:
+                # No marker (or one whose message is gone) counts as unread; the
+                # script never takes a counter below zero
+                read_score = read_up_to[member_id].value if member_id in read_up_to else None
+                if read_score is not None and read_score >= score:
+                    continue
+                repo.run_script(
+                    room_scripts.retract_unread,
+                    keys=[get_user_unread_key(member_id), get_user_mentions_key(member_id)],
+                    args=[room_id, "1" if member_id in mentions else "0"],
+                )
+        await asyncio.sleep(0)
+
+async def fan_out_room_activity(room_id: str, message: Dict[str, Any]) -> None:
+    """Move the room to the top of every other member's activity index and bump their
+    unread (and, if mentioned, mentions) counter, ACTIVITY_FANOUT_CHUNK members per pipeline"""
+    sender = message.get("sender") or ""
+    score = activity_score(message.get("timestamp"))
+    mentions = set(message.get("mentions") or [])
+    member_ids = [member_id for member_id in repo.rooms.member_ids(room_id) if member_id != sender]
+    for start in range(0, len(member_ids), ACTIVITY_FANOUT_CHUNK):
+        with repo.batch():
+            for member_id in member_ids[start:start + ACTIVITY_FANOUT_CHUNK]:
+                repo.activity.bump(member_id, room_id, score)
+                repo.unread.incr(member_id, room_id, member_id in mentions)
+        # Let other requests run between chunks of a large room
+        await asyncio.sleep(0)
+
+def mark_room_read(room_id: str, user_id: str, message_id: Optional[str] = None) -> Dict[str, Any]:
+    """Move the user's read marker; unread becomes the number of newer messages"""
+    if message_id:
+        result = find_message_index(room_id, message_id)
+        if not result:
+            raise HTTPException(status_code=404, detail="Message not found")
+        # Newest messages are at the head of the list
+        unread = result["index"]
+        newer = repo.messages.range(room_id, 0, unread - 1) if unread else []
+        mentions = sum(1 for message in newer if user_id in (message.get("mentions") or []))
+    else:
+        latest = repo.messages.range(room_id, 0, 0)
+        message_id = get_message_id(latest[0]) if latest else None
+        unread = mentions = 0
+    repo.unread.mark_read(user_id, room_id, message_id or "", unread, mentions)
+    return {"roomId": room_id, "message_id": message_id, "unread": unread, "mentions": mentions}
 
 @app.post("/orgs")
 async def create_org(payload: dict, current_user: dict = Depends(get_current_user)):
@@ -561,93 +1015,98 @@ async def create_org(payload: dict, current_user: dict = Depends(get_current_use
     owner = current_user.get("sub")
     created_at = datetime.now(timezone.utc).isoformat()
 
-    redis_client.hset(
-        get_org_key(org_id),
-        mapping={
-            "name": name,
-            "slug": slug,
-            "url": url,
-            "owner": owner,
-            "created_at": created_at,
-        },
-    )
-    redis_client.sadd(get_orgs_key(), org_id)
-
+    room_ids = []
     rooms = payload.get("rooms") or []
     if isinstance(rooms, list):
         for room_id in rooms:
             if isinstance(room_id, str) and room_id.strip():
-                redis_client.sadd(get_org_rooms_key(org_id), room_id.strip())
+                room_ids.append(room_id.strip())
 
+    event_items = []
     events = payload.get("events") or []
     if isinstance(events, list):
         for event in events:
             if isinstance(event, dict):
-                redis_client.rpush(get_org_events_key(org_id), json.dumps(event))
+                event_items.append(event)
             elif isinstance(event, str) and event.strip():
-                redis_client.rpush(
-                    get_org_events_key(org_id),
-                    json.dumps({"title": event.strip()}),
-                )
+                event_items.append({"title": event.strip()})
+
+    with repo.batch():
+        repo.orgs.create(
+            org_id,
+            {
+                "name": name,
+                "slug": slug,
+                "url": url,
+                "owner": owner,
+                "created_at": created_at,
+            },
+        )
+        if room_ids:
+            repo.orgs.add_rooms(org_id, *room_ids)
+        if event_items:
+            repo.orgs.add_events(org_id, *event_items)
+        bump_versions(get_orgs_key())
 
     return {
         "id": org_id,
         "name": name,
         "slug": slug,
         "url": url,
-        "rooms": [
-            room_id.decode()
-            for room_id in redis_client.smembers(get_org_rooms_key(org_id))
-        ],
+        "rooms": list(dict.fromkeys(room_ids)),
         "events": events,
     }
 
 
 @app.get("/orgs")
-async def get_orgs(current_user: dict = Depends(get_current_user)):
+async def get_orgs(
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_LIST_PAGE_SIZE),
+    current_user: dict = Depends(get_current_user)
+):
     """List organizations."""
-    org_ids = [org_id.decode() for org_id in redis_client.smembers(get_orgs_key())]
+    not_modified = check_not_modified(request, response, get_orgs_key())
+    if not_modified:
+        return not_modified
+
+    org_ids, next_cursor = paginate_ids(repo.orgs.ids(), cursor, limit)
     orgs = []
-    for org_id in org_ids:
-        data = redis_client.hgetall(get_org_key(org_id))
+    for org_id, data in repo.orgs.get_fields_many(org_ids, ORG_SIDEBAR_FIELDS).items():
         if not data:
             continue
         orgs.append(
             {
                 "id": org_id,
-                "name": data.get(b"name", b"").decode(),
-                "slug": data.get(b"slug", b"").decode(),
-                "url": data.get(b"url", b"").decode() or None,
+                "name": data.get("name") or "",
+                "slug": data.get("slug") or "",
+                "url": data.get("url") or None,
             }
         )
-    return {"orgs": orgs}
+    return {"orgs": orgs, "next_cursor": next_cursor}
 
 
 @app.get("/orgs/{org_id}")
 async def get_org(org_id: str, current_user: dict = Depends(get_current_user)):
     """Get organization details."""
-    data = redis_client.hgetall(get_org_key(org_id))
+    with repo.batch():
+        org = repo.orgs.get(org_id)
+        rooms = repo.orgs.room_ids(org_id)
+        events = repo.orgs.events(org_id)
+    data = org.value
     if not data:
         raise HTTPException(status_code=404, detail="Organization not found")
 
-    rooms = [
-        room_id.decode()
-        for room_id in redis_client.smembers(get_org_rooms_key(org_id))
-    ]
-    event_items = [
-        json.loads(item.decode())
-        for item in redis_client.lrange(get_org_events_key(org_id), 0, -1)
-    ]
-
     return {
         "id": org_id,
-        "name": data.get(b"name", b"").decode(),
-        "slug": data.get(b"slug", b"").decode(),
-        "url": data.get(b"url", b"").decode() or None,
-        "owner": data.get(b"owner", b"").decode(),
-        "created_at": data.get(b"created_at", b"").decode(),
-        "rooms": rooms,
-        "events": event_items,
+        "name": data.get("name", ""),
+        "slug": data.get("slug", ""),
+        "url": data.get("url") or None,
+        "owner": data.get("owner", ""),
+        "created_at": data.get("created_at", ""),
+        "rooms": rooms.value,
+        "events": events.value,
     }
 
 
@@ -660,10 +1119,10 @@ async def add_org_room(
     if not room_id:
         raise HTTPException(status_code=400, detail="room_id is required")
 
-    if not redis_client.exists(get_org_key(org_id)):
+    if not repo.orgs.exists(org_id):
         raise HTTPException(status_code=404, detail="Organization not found")
 
-    redis_client.sadd(get_org_rooms_key(org_id), room_id)
+    repo.orgs.add_rooms(org_id, room_id)
     return {"status": "ok", "room_id": room_id}
 
 
@@ -672,59 +1131,184 @@ async def add_org_event(
     org_id: str, payload: dict, current_user: dict = Depends(get_current_user)
 ):
     """Add an event to an organization."""
-    if not redis_client.exists(get_org_key(org_id)):
+    if not repo.orgs.exists(org_id):
         raise HTTPException(status_code=404, detail="Organization not found")
 
     if not isinstance(payload, dict) or not payload:
         raise HTTPException(status_code=400, detail="Event payload is required")
 
-    redis_client.rpush(get_org_events_key(org_id), json.dumps(payload))
+    repo.orgs.add_events(org_id, payload)
     return {"status": "ok"}
 
 @app.get("/user/rooms")
-async def get_user_rooms(current_user: dict = Depends(get_current_user)):
+async def get_user_rooms(
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_LIST_PAGE_SIZE),
+    current_user: dict = Depends(get_current_user)
+):
     """Get rooms created by or joined by current user"""
     user_id = current_user.get("sub")
-    room_ids = redis_client.smembers(get_user_rooms_key(user_id))
-    
+    not_modified = check_not_modified(request, response, "rooms", get_user_rooms_key(user_id))
+    if not_modified:
+        return not_modified
+
+    room_ids, next_cursor = paginate_ids(repo.users.room_ids(user_id), cursor, limit)
     rooms = []
-    for room_id in room_ids:
-        room_data = redis_client.hgetall(get_room_key(room_id.decode()))
+    for room_id, room_data in repo.rooms.get_fields_many(room_ids, ROOM_SIDEBAR_FIELDS).items():
         if room_data:
             rooms.append({
-                "id": room_id.decode(),
-                "name": room_data.get(b"name", b"").decode(),
-                "is_public": room_data.get(b"is_public", b"0") == b"1"
+                "id": room_id,
+                "name": room_data.get("name") or "",
+                "is_public": room_data.get("is_public") == "1"
             })
-    
-    return {"rooms": rooms}
+
+    return {"rooms": rooms, "next_cursor": next_cursor}
+
+def backfill_room_activity(user_id: str) -> None:
+    """Index rooms joined before the activity index existed, by their last message time"""
+    room_ids = repo.users.room_ids(user_id)
+    summaries = repo.activity.summaries(room_ids)
+    repo.activity.touch(user_id, {
+        room_id: activity_score(summary.get("timestamp")) if summary.get("timestamp") else 0
+        for room_id, summary in summaries.items()
+    })
+
+@app.get("/user/rooms/summary")
+async def get_user_rooms_summary(
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_PAGE_SIZE, ge=1, le=MAX_LIST_PAGE_SIZE),
+    current_user: dict = Depends(get_current_user)
+):
+    """Page of the user's rooms, most recently active first, with last-message previews"""
+    user_id = current_user.get("sub")
+    try:
+        offset = int(cursor) if cursor else 0
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if offset < 0:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    with repo.batch():
+        indexed = repo.activity.count(user_id)
+        joined = repo.users.room_count(user_id)
+    if indexed.value < joined.value:
+        backfill_room_activity(user_id)
+
+    # Fetch one extra entry to know whether another page follows
+    entries = repo.activity.page(user_id, offset, offset + limit)
+    page = entries[:limit]
+    with repo.batch():
+        details = {
+            room_id: (
+                repo.rooms.get_fields(room_id, ROOM_SIDEBAR_FIELDS),
+                repo.rooms.member_count(room_id),
+                repo.activity.summary(room_id),
+            )
+            for room_id, _ in page
+        }
+
+    unread_counts = repo.unread.counts_for(user_id, [room_id for room_id, _ in page])
+
+    rooms = []
+    for room_id, score in page:
+        fields, member_count, summary = details[room_id]
+        room_data = fields.value_or({})
+        if not room_data:
+            continue
+        summary = summary.value_or({})
+        last_message = None
+        if summary.get("message_id") or summary.get("preview"):
+            last_message = {
+                "id": summary.get("message_id") or None,
+                "sender": summary.get("sender") or None,
+                "timestamp": summary.get("timestamp") or None,
+                "preview": summary.get("preview") if summary.get("encrypted") != "1" else None,
+                "encrypted": summary.get("encrypted") == "1",
+            }
+        rooms.append({
+            "id": room_id,
+            "name": room_data.get("name") or "",
+            "is_public": room_data.get("is_public") == "1",
+            "member_count": member_count.value,
+            "unread": unread_counts[room_id][0],
+            "mentions": unread_counts[room_id][1],
+            "last_activity": score,
+            "last_message": last_message,
+        })
+
+    next_cursor = str(offset + limit) if len(entries) > limit else None
+    return {"rooms": rooms, "next_cursor": next_cursor}
+
+@app.get("/user/unread")
+async def get_unread_counts(current_user: dict = Depends(get_current_user)):
+    """Unread and mention counts for every room with activity since the user's read marker"""
+    user_id = current_user.get("sub")
+    with repo.batch():
+        counts = repo.unread.counts(user_id)
+        mentions = repo.unread.mentions(user_id)
+        markers = repo.unread.markers(user_id)
+    counts, mentions, markers = counts.value, mentions.value, markers.value
+
+    rooms = {
+        room_id: {
+            "unread": counts.get(room_id, 0),
+            "mentions": mentions.get(room_id, 0),
+            "read_marker": markers.get(room_id) or None,
+        }
+        for room_id in set(counts) | set(mentions)
+    }
+    return {
+        "rooms": rooms,
+        "total_unread": sum(counts.values()),
+        "total_mentions": sum(mentions.values()),
+    }
+
+@app.put("/rooms/{room_id}/read")
+async def set_read_marker(
+    room_id: str,
+    payload: Optional[dict] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Mark a room read up to message_id, or up to its latest message if omitted"""
+    user_id = current_user.get("sub")
+    if not repo.rooms.is_member(room_id, user_id):
+        raise HTTPException(status_code=403, detail="Access denied")
+    return mark_room_read(room_id, user_id, (payload or {}).get("message_id"))
 
 @app.get("/rooms")
-async def get_rooms(current_user: list = Depends(get_current_user)):
+async def get_rooms(
+    request: Request,
+    response: Response,
+    current_user: list = Depends(get_current_user)
+):
     """Get list of public rooms + private rooms user is invited to"""
     user_id = current_user.get("sub")
+    not_modified = check_not_modified(request, response, "rooms", get_user_rooms_key(user_id))
+    if not_modified:
+        return not_modified
+
     all_rooms = []
     
-    # Get all room keys safely
-    room_keys = redis_client.keys("room:*")
-    for key in room_keys:
-        key_str = key.decode()
-        if key_str.endswith(":users") or key_str.endswith(":pubsub") or key_str.endswith(":messages"):
-            continue
-            
-        room_id = key_str.split(":")[1]
-        try:
-            room_data = redis_client.hgetall(key)
-            if room_data:
-                is_public = room_data.get(b"is_public", b"0") == b"1"
-                if is_public or check_room_access(room_id, user_id):
-                    all_rooms.append({
-                        "id": room_id,
-                        "name": room_data.get(b"name", b"").decode(),
-                        "is_public": is_public
-                    })
-        except redis.exceptions.ResponseError:
-            continue  # Skip keys that aren't hashes
+    # Get all room keys safely; nested keys like room:{id}:users aren't rooms
+    room_ids = [
+        key.decode().split(":")[1]
+        for key in redis_client.keys("room:*")
+        if key.decode().count(":") == 1
+    ]
+    member_room_ids = set(repo.users.room_ids(user_id))
+
+    # Keys that aren't hashes come back empty and are skipped
+    for room_id, room_data in repo.rooms.get_many(room_ids).items():
+        if room_data:
+            is_public = room_data.get("is_public", "0") == "1"
+            if is_public or room_id in member_room_ids:
+                all_rooms.append({
+                    "id": room_id,
+                    "name": room_data.get("name", ""),
+                    "is_public": is_public
+                })
     
     return all_rooms
 
@@ -743,10 +1327,6 @@ async def create_room(payload: dict, current_user: dict = Depends(get_current_us
     if not room_id:
         room_id = str(uuid.uuid4())
 
-    room_key = get_room_key(room_id)
-    if redis_client.exists(room_key):
-        raise HTTPException(status_code=409, detail="Room already exists")
-
     is_public = 1 if payload.get("is_public") else 0
 
     new_room = {
@@ -755,10 +1335,8 @@ async def create_room(payload: dict, current_user: dict = Depends(get_current_us
         "is_public": is_public,
         "creator": user_id,
     }
-    redis_client.hset(room_key, mapping=new_room)
-    redis_client.sadd(get_users_key(room_id), user_id)
-    redis_client.sadd(get_user_rooms_key(user_id), room_id)
-    redis_client.sadd(get_admins_key(room_id), user_id)
+    if not create_room_record(room_id, new_room, [user_id]):
+        raise HTTPException(status_code=409, detail="Room already exists")
 
     return {
         "id": room_id,
@@ -770,19 +1348,19 @@ async def create_room(payload: dict, current_user: dict = Depends(get_current_us
 async def join_room(room_id: str, current_user: dict = Depends(get_current_user)):
     """Validate and add user to room"""
     user_id = current_user.get("sub")
-    if not check_room_access(room_id, user_id):
+    # Access check and membership writes happen in one script
+    if not add_room_member(room_id, user_id, require_access=True):
         raise HTTPException(status_code=403, detail="Access denied")
-    
-    # Add user to room's Redis set
-    redis_client.sadd(get_users_key(room_id), user_id)
-    # Add room to user's rooms set (like we do in create_room)
-    redis_client.sadd(get_user_rooms_key(user_id), room_id)
     return {"status": "joined"}
 
 @app.post("/rooms/{room_id}/message")
 async def post_message(room_id: str, message: dict, current_user: dict = Depends(get_current_user)):
     """Post message to room - handles all message types uniformly"""
-    user_id = current_user.get("sub")
+    await send_room_message(room_id, message, current_user.get("sub"))
+    return {"status": "message sent"}
+
+async def send_room_message(room_id: str, message: dict, user_id: str) -> Dict[str, Any]:
+    """Store, publish and broadcast a message from user_id; returns the broadcast message"""
     if not check_room_access(room_id, user_id):
         raise HTTPException(status_code=403, detail="Access denied")
     
@@ -802,6 +1380,38 @@ async def post_message(room_id: str, message: dict, current_user: dict = Depends
                 content_uuid = parsed.get("uuid")
             except json.JSONDecodeError:
                 content_uuid = None
+    if not content_uuid and isinstance(message.get("content"), dict):
+        content_uuid = message["content"].get("uuid")
+
+    # Replies are threaded under the root of the message they answer
+    thread_root = None
+    reply_to = message.pop("reply_to", None)
+    message.pop("thread_root", None)
+    if reply_to is not None:
+        if not isinstance(reply_to, str) or not reply_to:
+            raise HTTPException(status_code=400, detail="reply_to must be a message id")
+        thread_root = resolve_thread_root(room_id, reply_to)
+        if not thread_root:
+            raise HTTPException(status_code=404, detail="Message to reply to not found")
+        # Replies need an id of their own to be found in their thread
+        content_uuid = content_uuid or str(uuid.uuid4())
+        message["reply_to"] = reply_to
+        message["thread_root"] = thread_root
+
+    attachments = message.get("attachments")
+    if attachments is not None:
+        message["attachments"] = resolve_attachments(attachments, user_id)
+        # Members of this room may now download these attachments
+        for attachment in message["attachments"]:
+            redis_client.sadd(get_attachment_rooms_key(attachment["id"]), room_id)
+
+    mentions = extract_mentions(message)
+    message.pop("mentions", None)
+    if mentions:
+        message["mentions"] = mentions
+        # Mention inbox entries point at the message by id
+        content_uuid = content_uuid or str(uuid.uuid4())
+    mentioned = mention_recipients(room_id, user_id, mentions)
 
     # Enforce server-controlled fields
     message.update({
@@ -811,21 +1421,69 @@ async def post_message(room_id: str, message: dict, current_user: dict = Depends
         "content_uuid": content_uuid
     })
     
-    # Store message in Redis list (persistent storage)
-    message_key = f"room:{room_id}:messages"
-    redis_client.lpush(message_key, json.dumps(message))
-    
-    # Publish to Redis pubsub for real-time delivery
-    pubsub_key = get_pubsub_key(room_id)
-    message_json = json.dumps(message)
-    print(f"Publishing message to Redis channel {pubsub_key}: {message_json}")
-    redis_client.publish(pubsub_key, message_json)
+    # Large or encrypted content is kept out of the room list and out of
+    # published events; clients fetch it by hash from the payload endpoint
+    stored_message = message
+    payload = externalize_payload(room_id, message.get("content"))
+    if payload:
+        stored_message = {k: v for k, v in message.items() if k != "content"}
+        stored_message["payload"] = payload
+        message["payload"] = payload
+
+    # Store message in Redis list (persistent storage) and publish to
+    # Redis pubsub for real-time delivery in one round trip, shared with
+    # other new messages when the write-behind buffer is on
+    message_json = json.dumps(stored_message)
+    def write():
+        repo.messages.push(room_id, stored_message)
+        repo.messages.publish(room_id, message_json)
+        record_room_activity(room_id, message)
+        index_message(room_id, message)
+        repo.messages.index_time(room_id, {timeline_member(message): activity_score(message["timestamp"])})
+        if thread_root:
+            repo.threads.add_reply(
+                room_id, thread_root, content_uuid, stored_message, activity_score(message["timestamp"])
+            )
+        for mentioned_id in mentioned:
+            repo.mentions.add(
+                mentioned_id,
+                repo.mentions.entry(room_id, content_uuid, user_id),
+                activity_score(message["timestamp"]),
+                MENTION_INBOX_LENGTH,
+            )
+        return repo.messages.append_event(room_id, stored_message, SSE_REPLAY_LENGTH)
+
+    event_id = await write_buffer.submit(write)
+    # Queued ahead of the broadcast so members' unread counts include this
+    # message before they can see it and mark it read
+    await dispatcher.submit(room_id, fan_out_room_activity, room_id, message)
     
-    # Broadcast to all WebSocket connections in this room
-    print(f"Broadcasting to WebSocket connections for room {room_id}")
-    await manager.broadcast(room_id, message)
-    print("Broadcast complete")
-    return {"status": "message sent"}
+    # Broadcast to all WebSocket connections in this room once it's stored
+    await dispatcher.submit(
+        room_id,
+        manager.broadcast,
+        room_id,
+        stored_message,
+        activity={
+            "type": "room_activity",
+            "roomId": room_id,
+            "sender": user_id,
+            "timestamp": message["timestamp"],
+        },
+        event_id=event_id.value,
+    )
+    if mentioned:
+        notice = {
+            "type": "mention",
+            "roomId": room_id,
+            "message_id": content_uuid,
+            "sender": user_id,
+            "timestamp": message["timestamp"],
+            "preview": build_message_preview(message.get("content"), message.get("payload")),
+        }
+        for mentioned_id in mentioned:
+            await dispatcher.submit(room_id, manager.send_to_user, mentioned_id, notice)
+    return message
 
 @app.put("/rooms/{room_id}")
 async def update_room(
@@ -839,20 +1497,18 @@ async def update_room(
         raise HTTPException(status_code=400, detail="Invalid user ID")
     
     # Check if user is admin of this room
-    if not redis_client.sismember(get_admins_key(room_id), user_id):
+    if not repo.rooms.is_admin(room_id, user_id):
         raise HTTPException(status_code=403, detail="Only admins can update room settings")
 
     print(f"Updating room {room_id} with data: {room_update}")  # Debug log
 
     # Update room data in Redis
-    redis_client.hset(
-        get_room_key(room_id),
-        mapping=room_update
-    )
-    
-    # Verify the update was successful
-    updated_data = redis_client.hgetall(get_room_key(room_id))
-    print(f"Room data after update: {updated_data}")  # Debug log
+    with repo.batch():
+        repo.rooms.update(room_id, room_update)
+        bump_versions("rooms")
+        # Verify the update was successful
+        updated_data = repo.rooms.get(room_id)
+    print(f"Room data after update: {updated_data.value}")  # Debug log
     
     return {"status": "room updated"}
 
@@ -868,21 +1524,8 @@ async def delete_dm_room(
     if "_" not in room_id:
         raise HTTPException(status_code=400, detail="Only direct message rooms can be deleted")
 
-    if not redis_client.sismember(get_users_key(room_id), user_id):
+    if not delete_room_record(room_id, user_id):
         raise HTTPException(status_code=403, detail="Access denied")
-
-    member_ids = redis_client.smembers(get_users_key(room_id))
-    for member in member_ids:
-        member_id = member.decode()
-        redis_client.srem(get_user_rooms_key(member_id), room_id)
-
-    redis_client.delete(
-        get_room_key(room_id),
-        get_users_key(room_id),
-        get_admins_key(room_id),
-        f"room:{room_id}:messages",
-        get_pubsub_key(room_id),
-    )
     return {"status": "room deleted"}
 
 @app.get("/rooms/{room_id}")
@@ -895,43 +1538,34 @@ async def get_room(
     if not user_id:
         raise HTTPException(status_code=403, detail="Not authenticated")
 
-    room_key = get_room_key(room_id)
-
     # Check if room exists, if not create it
-    if not redis_client.exists(room_key):
-        print(f"Creating new room: {room_id}")  # Debug log
+    if not repo.rooms.exists(room_id):
         is_dm = "_" in room_id
         if is_dm:
             admins = list(set(room_id.split("_")))  # Remove duplicates
         else:
             admins = [user_id]
         
-        # Create regular room
+        # Create regular room; for DM rooms both users become members and admins
         new_room = {
             "id": room_id,
             "name": f"Room {room_id[:8]}",
             "is_public": 0,
             "creator": user_id
         }
-        redis_client.hset(room_key, mapping=new_room)
-        
-        # For DM rooms, add both users as members and admins
-        for user in admins:  # admins contains both users for DM rooms
-            redis_client.sadd(get_users_key(room_id), user)
-            redis_client.sadd(get_user_rooms_key(user), room_id)
-            redis_client.sadd(get_admins_key(room_id), user)
+        if create_room_record(room_id, new_room, admins):
+            print(f"Created new room: {room_id}")  # Debug log
     
     # Check if user has access to the room
     if not check_room_access(room_id, user_id):
         raise HTTPException(status_code=403, detail="Access denied")
     
-    # Get room data from Redis and convert bytes to strings
-    room_data = redis_client.hgetall(room_key)
-    room_dict = {k.decode(): v.decode() for k, v in room_data.items()}
-    
-    # Get list of admin user IDs
-    admin_ids = redis_client.smembers(get_admins_key(room_id))
-    admins = [admin_id.decode() for admin_id in admin_ids] if admin_ids else []
+    # Get room data and list of admin user IDs in one round trip
+    with repo.batch():
+        room_data = repo.rooms.get(room_id)
+        admin_ids = repo.rooms.admin_ids(room_id)
+    room_dict = room_data.value
+    admins = admin_ids.value
     
     return {
         "id": room_id,
@@ -941,38 +1575,373 @@ async def get_room(
         "admins": admins
     }
 
+@app.get("/rooms/{room_id}/search")
+async def search_room_messages(
+    room_id: str,
+    q: str = Query(..., min_length=1, max_length=200),
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_PAGE_SIZE, ge=1, le=MAX_LIST_PAGE_SIZE),
+    current_user: dict = Depends(get_current_user)
+):
+    """Ranked page of the room's plaintext messages matching q"""
+    user_id = current_user.get("sub")
+    if not check_room_access(room_id, user_id):
+        raise HTTPException(status_code=403, detail="Access denied")
+    try:
+        offset = int(cursor) if cursor else 0
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if offset < 0:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    terms = query_terms(q)
+    counts = repo.search.term_counts(room_id, terms) if terms else {}
+    weights = {term: idf(counts[""], counts[term]) for term in terms if counts[term]}
+    if not weights:
+        return {"results": [], "next_cursor": None}
+
+    # Hidden results are skipped before paging, so the cursor is the position
+    # in the ranked union just past the last result returned. Only a first
+    # page rebuilds the union; later pages page through the same ranking.
+    results = []
+    position = offset
+    refresh = offset == 0
+    while len(results) < limit:
+        ranked = repo.search.ranked(
+            room_id, weights, position, position + limit - 1, SEARCH_RESULTS_TTL, refresh=refresh
+        )
+        refresh = False
+        if not ranked:
+            break
+        documents = repo.search.documents(room_id, [doc_id for doc_id, _ in ranked])
+        for doc_id, score in ranked:
+            position += 1
+            document = documents.get(doc_id)
+            if not document:
+                continue
+            sender = document.get("sender")
+            if sender and user_id in repo.blockers(sender):
+                continue
+            results.append({
+                "message_id": doc_id,
+                "sender": sender,
+                "timestamp": document.get("timestamp"),
+                "snippet": snippet(document.get("text") or "", list(weights)),
+                "score": round(score, 4),
+            })
+            if len(results) == limit:
+                break
+
+    has_more = len(results) == limit and bool(
+        repo.search.ranked(room_id, weights, position, position, SEARCH_RESULTS_TTL)
+    )
+    next_cursor = str(position) if has_more else None
+    return {"results": results, "next_cursor": next_cursor}
+
+@app.get("/mentions")
+async def get_mentions(
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_PAGE_SIZE, ge=1, le=MAX_LIST_PAGE_SIZE),
+    current_user: dict = Depends(get_current_user)
+):
+    """Page of messages mentioning the user, newest first; the cursor is the last entry's score and member"""
+    user_id = current_user.get("sub")
+    before = parse_mention_cursor(cursor) if cursor else None
+
+    with repo.batch():
+        unread = repo.unread.mentions(user_id)
+        rooms = repo.users.room_ids(user_id)
+    joined = set(rooms.value)
+
+    # Entries from rooms the user has since left (or that were deleted) and
+    # from blocked senders are skipped before paging, reading ahead in chunks
+    mentions = []
+    last = None
+    has_more = False
+    offset = 0
+    while not has_more:
+        entries = repo.mentions.page(user_id, before[0] if before else None, offset, limit + 1)
+        if not entries:
+            break
+        offset += len(entries)
+        for member, score in entries:
+            # Equal scores come in descending member order; skip up to the cursor
+            if before and score == before[0] and member >= before[1]:
+                continue
+            if len(mentions) == limit:
+                has_more = True
+                break
+            last = (score, member)
+            room_id, message_id, sender = json.loads(member)
+            if room_id not in joined or user_id in repo.blockers(sender):
+                continue
+            mentions.append({
+                "roomId": room_id,
+                "message_id": message_id,
+                "sender": sender,
+                "timestamp": datetime.fromtimestamp(score, timezone.utc).isoformat(),
+            })
+
+    return {
+        "mentions": mentions,
+        "unread": sum(unread.value.values()),
+        "next_cursor": format_mention_cursor(*last) if has_more else None,
+    }
+
+def format_mention_cursor(score: float, member: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([score, member]).encode()).decode()
+
+def parse_mention_cursor(cursor: str) -> tuple:
+    try:
+        score, member = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(score), str(member)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@app.get("/rooms/{room_id}/presence")
+async def get_room_presence(room_id: str, current_user: dict = Depends(get_current_user)):
+    """Members of the room with a live WebSocket, and when each was last heard from"""
+    if not check_room_access(room_id, current_user.get("sub")):
+        raise HTTPException(status_code=403, detail="Access denied")
+    member_ids = sorted(repo.rooms.member_ids(room_id))
+    last_seen = repo.presence.last_seen(member_ids)
+    return {
+        "roomId": room_id,
+        "online": list(last_seen),
+        "last_seen": last_seen,
+        "member_count": len(member_ids),
+    }
+
+def filter_blocked(messages: List[Dict[str, Any]], viewer_id: Optional[str]) -> List[Dict[str, Any]]:
+    """Drop messages from senders the viewer has blocked"""
+    if not viewer_id:
+        return messages
+    return [
+        message for message in messages
+        if not message.get("sender") or viewer_id not in repo.blockers(message["sender"])
+    ]
+
 @app.get("/rooms/{room_id}/messages")
 async def get_room_messages(
     room_id: str,
+    around: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_LIST_PAGE_SIZE),
     current_user: dict = Depends(get_current_user)
 ):
-    """Get messages for a room"""
+    """Get messages for a room; with around= (ISO time or epoch seconds), only the page surrounding it.
+
+    Without around=, limit keeps only the newest messages; with neither, the
+    whole history is returned as before.
+    """
     if not check_room_access(room_id, current_user.get("sub")):
         raise HTTPException(status_code=403, detail="Access denied")
-    
-    message_key = f"room:{room_id}:messages"
-    messages = redis_client.lrange(message_key, 0, -1)
-    parsed_messages = []
-    
-    for msg in messages:
-        try:
-            msg_data = json.loads(msg.decode('utf-8'))
-            parsed_messages.append(msg_data)
-        except Exception as e:
-            print(f"Error parsing message: {e}")
-            continue
-            
-    return {"messages": parsed_messages}
+
+    if around is None:
+        stop = limit - 1 if limit else -1
+        parsed_messages = filter_blocked(repo.messages.range(room_id, 0, stop), current_user.get("sub"))
+        return ORJSONResponse({"messages": add_reply_counts(room_id, parsed_messages)})
+
+    limit = limit or LIST_PAGE_SIZE
+    instant = parse_instant(around)
+    ensure_room_timeline(room_id)
+    total = repo.messages.length(room_id)
+
+    # Newest messages are at the head of the list, so the number posted after
+    # the instant is the index of the first message at or before it
+    position = repo.messages.count_newer(room_id, instant)
+    start = max(min(position - limit // 2, total - limit), 0)
+    stop = start + limit - 1
+    parsed_messages = filter_blocked(repo.messages.range(room_id, start, stop), current_user.get("sub"))
+    return ORJSONResponse({
+        "messages": add_reply_counts(room_id, parsed_messages),
+        "start": start,
+        "position": position,
+        "has_newer": start > 0,
+        "has_older": stop + 1 < total,
+    })
+
+@app.get("/rooms/{room_id}/threads/{root_id}")
+async def get_thread(
+    room_id: str,
+    root_id: str,
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_PAGE_SIZE, ge=1, le=MAX_LIST_PAGE_SIZE),
+    current_user: dict = Depends(get_current_user)
+):
+    """Page of replies to a root message, oldest first"""
+    user_id = current_user.get("sub")
+    if not check_room_access(room_id, user_id):
+        raise HTTPException(status_code=403, detail="Access denied")
+    try:
+        offset = int(cursor) if cursor else 0
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if offset < 0:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    summary = repo.threads.summary(room_id, root_id)
+    if not summary and not resolve_thread_root(room_id, root_id):
+        raise HTTPException(status_code=404, detail="Message not found")
+
+    # Fetch one extra entry to know whether another page follows
+    replies = repo.threads.page(room_id, root_id, offset, offset + limit)
+    next_cursor = str(offset + limit) if len(replies) > limit else None
+    return ORJSONResponse({
+        "root_id": root_id,
+        "reply_count": int(summary.get("reply_count") or 0),
+        "last_reply_at": summary.get("last_reply_at") or None,
+        "replies": filter_blocked(replies[:limit], user_id),
+        "next_cursor": next_cursor,
+    })
+
+def parse_instant(value: str) -> float:
+    """Epoch seconds from an ISO 8601 timestamp or a number of epoch seconds"""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        instant = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid timestamp")
+    if instant.tzinfo is None:
+        instant = instant.replace(tzinfo=timezone.utc)
+    return instant.timestamp()
+
+def timeline_member(message: Dict[str, Any]) -> str:
+    """Time index member for a message: its id, or sender and time for id-less messages"""
+    return get_message_id(message) or f"{message.get('timestamp')}|{message.get('sender')}"
+
+def resolve_thread_root(room_id: str, message_id: str) -> Optional[str]:
+    """Root of the thread message_id belongs to (itself if it isn't a reply); None if it doesn't exist"""
+    ensure_room_timeline(room_id)
+    with repo.batch():
+        posted = repo.messages.time_score(room_id, message_id)
+        reply = repo.threads.reply(room_id, message_id)
+    if posted.value is None:
+        return None
+    return (reply.value or {}).get("thread_root") or message_id
+
+def add_reply_counts(room_id: str, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Annotate thread roots with their reply count and latest reply time"""
+    # One summary lookup per message on the page; only thread roots have one
+    ids = {get_message_id(message) for message in messages} - {None}
+    if not ids:
+        return messages
+    summaries = repo.threads.summaries(room_id, list(ids))
+    for message in messages:
+        summary = summaries.get(get_message_id(message))
+        if summary:
+            message["reply_count"] = int(summary.get("reply_count") or 0)
+            message["last_reply_at"] = summary.get("last_reply_at") or None
+    return messages
+
+def ensure_room_timeline(room_id: str) -> None:
+    """Index messages posted before the time index existed, once per room"""
+    if repo.messages.time_backfilled(room_id):
+        return
+    scores = {}
+    for message in repo.messages.range(room_id):
+        timestamp = message.get("timestamp")
+        scores[timeline_member(message)] = activity_score(timestamp) if timestamp else 0
+    with repo.batch():
+        if scores:
+            repo.messages.index_time(room_id, scores)
+        repo.messages.mark_time_backfilled(room_id)
+
+def read_tdf_policy(content: str) -> Optional[Dict[str, Any]]:
+    """Pull the policy summary out of a base64 ZTDF manifest, if present"""
+    try:
+        archive_bytes = base64.b64decode(content[3:])
+        with zipfile.ZipFile(io.BytesIO(archive_bytes)) as archive:
+            manifest = json.loads(archive.read("0.manifest.json"))
+        policy = json.loads(
+            base64.b64decode(manifest["encryptionInformation"]["policy"])
+        )
+    except Exception:
+        return None
+
+    body = policy.get("body") or {}
+    return {
+        "uuid": policy.get("uuid"),
+        "attributes": [
+            attribute.get("attribute")
+            for attribute in body.get("dataAttributes") or []
+            if isinstance(attribute, dict)
+        ],
+        "dissem": body.get("dissem") or [],
+    }
+
+def externalize_payload(room_id: str, content: Any) -> Optional[Dict[str, Any]]:
+    """Move TDF or oversized content to the payload store and describe it"""
+    if isinstance(content, str):
+        encoding = "tdf" if content.strip().startswith("TDF") else "text"
+        data = content.encode("utf-8")
+    elif isinstance(content, (dict, list)):
+        encoding = "json"
+        data = json.dumps(content).encode("utf-8")
+    else:
+        return None
+    if encoding != "tdf" and len(data) <= INLINE_PAYLOAD_LIMIT:
+        return None
+
+    payload_hash = hash_bytes(data)
+    payload_store.put(payload_hash, data)
+    redis_client.sadd(get_room_payloads_key(room_id), payload_hash)
+    redis_client.sadd(get_payload_rooms_key(payload_hash), room_id)
+    # Messages referencing the blob, so edits and deletes can release it
+    redis_client.hincrby(get_room_payload_refs_key(room_id), payload_hash, 1)
+
+    payload = {"hash": payload_hash, "size": len(data), "encoding": encoding}
+    if encoding == "tdf":
+        payload["policy"] = read_tdf_policy(content.strip())
+    return payload
+
+@app.get("/rooms/{room_id}/payloads/{payload_hash}")
+async def get_room_payload(
+    room_id: str,
+    payload_hash: str,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security),
+):
+    """Fetch externalized message content; immutable, so clients cache it by hash.
+
+    Public rooms need no token, so anonymous stream viewers can load content
+    that message events only reference by hash.
+    """
+    user_id = ""
+    if credentials:
+        payload = await keycloak.verify_token(credentials.credentials)
+        user_id = payload.get("sub") or ""
+    if not check_room_access(room_id, user_id):
+        raise HTTPException(status_code=403, detail="Access denied")
+    if not is_valid_hash(payload_hash) or not redis_client.sismember(
+        get_room_payloads_key(room_id), payload_hash
+    ):
+        raise HTTPException(status_code=404, detail="Payload not found")
+    if not payload_store.exists(payload_hash):
+        raise HTTPException(status_code=404, detail="Payload not found")
+
+    return FileResponse(
+        payload_store.path_for(payload_hash),
+        media_type="text/plain; charset=utf-8",
+        headers={
+            "Cache-Control": "private, max-age=31536000, immutable",
+            "ETag": f'"{payload_hash}"',
+        },
+    )
 
 def find_message_index(room_id: str, message_id: str) -> Optional[Dict[str, Any]]:
-    message_key = f"room:{room_id}:messages"
-    messages = redis_client.lrange(message_key, 0, -1)
+    messages = repo.messages.raw_range(room_id)
+    message_id_bytes = message_id.encode("utf-8")
     for index, msg in enumerate(messages):
+        # Every match carries the id verbatim, so skip parsing everything else
+        if message_id_bytes not in msg:
+            continue
         try:
             msg_data = json.loads(msg.decode("utf-8"))
         except Exception:
             continue
-        if msg_data.get("content_uuid") == message_id:
+        if get_message_id(msg_data) == message_id:
             return {"index": index, "message": msg_data}
         content = msg_data.get("content")
         if isinstance(content, str):
@@ -993,7 +1962,11 @@ async def edit_room_message(
     payload: dict,
     current_user: dict = Depends(get_current_user)
 ):
-    user_id = current_user.get("sub")
+    await edit_message(room_id, message_id, payload.get("content"), current_user.get("sub"))
+    return {"status": "message updated"}
+
+async def edit_message(room_id: str, message_id: str, new_content: Any, user_id: str) -> Dict[str, Any]:
+    """Replace the content of user_id's own message and broadcast the edit"""
     if not check_room_access(room_id, user_id):
         raise HTTPException(status_code=403, detail="Access denied")
 
@@ -1005,29 +1978,54 @@ async def edit_room_message(
     if msg_data.get("sender") != user_id:
         raise HTTPException(status_code=403, detail="Cannot edit another user's message")
 
-    new_content = payload.get("content")
     if new_content is None:
         raise HTTPException(status_code=400, detail="Missing content")
 
-    msg_data["content"] = new_content
     msg_data["content_uuid"] = message_id
     msg_data["edited_at"] = datetime.now(timezone.utc).isoformat()
+    previous_payload = msg_data.get("payload")
+    payload = externalize_payload(room_id, new_content)
+    if payload:
+        msg_data.pop("content", None)
+        msg_data["payload"] = payload
+    else:
+        msg_data.pop("payload", None)
+        msg_data["content"] = new_content
+
+    preview = build_message_preview(new_content, payload)
+    # Externalized content goes out by hash only, as for new messages
+    event = {
+        "type": "message_edit",
+        "roomId": room_id,
+        "message_id": message_id,
+        "payload": payload,
+        "sender": user_id,
+        "edited_at": msg_data["edited_at"],
+    }
+    if payload is None:
+        event["content"] = new_content
+    indexed = repo.search.document(room_id, message_id)
+    with repo.batch():
+        repo.messages.set(room_id, result["index"], msg_data)
+        event_id = repo.messages.append_event(room_id, event, SSE_REPLAY_LENGTH)
+        if indexed:
+            repo.search.remove(room_id, message_id, indexed["terms"])
+        index_message(room_id, {**msg_data, "content": new_content, "payload": payload})
+        if msg_data.get("thread_root"):
+            repo.threads.set_reply(room_id, message_id, msg_data)
+        repo.run_script(
+            room_scripts.update_summary,
+            keys=[get_room_summary_key(room_id)],
+            args=[
+                message_id,
+                "preview", preview or "",
+                "encrypted", "1" if preview is None else "0",
+            ],
+        )
+    release_payload(room_id, previous_payload)
 
-    message_key = f"room:{room_id}:messages"
-    redis_client.lset(message_key, result["index"], json.dumps(msg_data))
-
-    await manager.broadcast(
-        room_id,
-        {
-            "type": "message_edit",
-            "roomId": room_id,
-            "message_id": message_id,
-            "content": new_content,
-            "sender": user_id,
-            "edited_at": msg_data["edited_at"],
-        },
-    )
-    return {"status": "message updated"}
+    await dispatcher.submit(room_id, manager.broadcast, room_id, event, event_id=event_id.value)
+    return event
 
 @app.delete("/rooms/{room_id}/messages/{message_id}")
 async def delete_room_message(
@@ -1035,7 +2033,11 @@ async def delete_room_message(
     message_id: str,
     current_user: dict = Depends(get_current_user)
 ):
-    user_id = current_user.get("sub")
+    await delete_message(room_id, message_id, current_user.get("sub"))
+    return {"status": "message deleted"}
+
+async def delete_message(room_id: str, message_id: str, user_id: str) -> Dict[str, Any]:
+    """Delete user_id's own message and broadcast the deletion"""
     if not check_room_access(room_id, user_id):
         raise HTTPException(status_code=403, detail="Access denied")
 
@@ -1047,25 +2049,315 @@ async def delete_room_message(
     if msg_data.get("sender") != user_id:
         raise HTTPException(status_code=403, detail="Cannot delete another user's message")
 
-    message_key = f"room:{room_id}:messages"
-    tombstone = json.dumps({"_deleted": True, "content_uuid": message_id})
-    redis_client.lset(message_key, result["index"], tombstone)
-    redis_client.lrem(message_key, 1, tombstone)
+    event = {
+        "type": "message_delete",
+        "roomId": room_id,
+        "message_id": message_id,
+        "sender": user_id,
+    }
+    indexed = repo.search.document(room_id, message_id)
+    with repo.batch():
+        repo.messages.remove_at(room_id, result["index"], message_id)
+        repo.messages.unindex_time(room_id, timeline_member(msg_data))
+        if msg_data.get("thread_root"):
+            repo.threads.remove_reply(room_id, msg_data["thread_root"], message_id)
+        for mentioned_id in msg_data.get("mentions") or []:
+            repo.mentions.remove(mentioned_id, repo.mentions.entry(room_id, message_id, user_id))
+        if indexed:
+            repo.search.remove(room_id, message_id, indexed["terms"])
+        summary = repo.activity.summary(room_id)
+        latest = repo.messages.range(room_id, 0, 0)
+        event_id = repo.messages.append_event(room_id, event, SSE_REPLAY_LENGTH)
+    release_payload(room_id, msg_data.get("payload"))
+    # Keep the room's position but show the new latest message in previews
+    if summary.value.get("message_id") == message_id:
+        if latest.value:
+            repo.activity.set_summary(room_id, build_room_summary(latest.value[0]))
+        else:
+            repo.activity.set_summary(
+                room_id, {"message_id": "", "sender": "", "preview": "", "encrypted": "0"}
+            )
 
-    await manager.broadcast(
-        room_id,
-        {
-            "type": "message_delete",
-            "roomId": room_id,
-            "message_id": message_id,
-            "sender": user_id,
-        },
+    await dispatcher.submit(room_id, retract_room_activity, room_id, msg_data)
+    await dispatcher.submit(room_id, manager.broadcast, room_id, event, event_id=event_id.value)
+    return event
+
+def resolve_attachments(attachments: Any, user_id: str) -> List[Dict[str, Any]]:
+    """Validate message attachment references against uploaded blobs the sender may see"""
+    if not isinstance(attachments, list):
+        raise HTTPException(status_code=400, detail="attachments must be a list")
+
+    resolved = []
+    for attachment in attachments:
+        if isinstance(attachment, str):
+            attachment = {"id": attachment}
+        attachment_id = attachment.get("id") if isinstance(attachment, dict) else None
+        if not is_valid_hash(attachment_id or ""):
+            raise HTTPException(status_code=400, detail="Invalid attachment reference")
+        meta = redis_client.hgetall(get_attachment_key(attachment_id))
+        if not meta:
+            raise HTTPException(status_code=400, detail=f"Unknown attachment {attachment_id}")
+        if not can_view_attachment(attachment_id, user_id):
+            raise HTTPException(status_code=403, detail=f"Access denied to attachment {attachment_id}")
+        resolved.append({
+            "id": attachment_id,
+            "size": int(meta.get(b"size", b"0")),
+            "content_type": meta.get(b"content_type", b"application/octet-stream").decode(),
+            "filename": attachment.get("filename") or meta.get(b"filename", b"").decode() or None,
+        })
+    return resolved
+
+def get_upload_session(upload_id: str, user_id: str) -> Dict[str, str]:
+    upload_data = redis_client.hgetall(get_upload_key(upload_id))
+    if not upload_data:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    session = {k.decode(): v.decode() for k, v in upload_data.items()}
+    if session.get("owner") != user_id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    return session
+
+def upload_part_path(upload_id: str) -> str:
+    return os.path.join(UPLOADS_DIR, f"{upload_id}.part")
+
+def remove_stale_uploads() -> int:
+    """Delete .part files whose upload session has expired"""
+    cutoff = datetime.now().timestamp() - UPLOAD_SESSION_TTL
+    removed = 0
+    for name in os.listdir(UPLOADS_DIR):
+        if not name.endswith(".part"):
+            continue
+        path = os.path.join(UPLOADS_DIR, name)
+        try:
+            if os.path.getmtime(path) > cutoff:
+                continue
+            if redis_client.exists(get_upload_key(name[:-len(".part")])):
+                continue
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            continue
+    return removed
+
+async def sweep_uploads():
+    while True:
+        try:
+            removed = await asyncio.to_thread(remove_stale_uploads)
+            if removed:
+                metrics.incr("uploads.swept", removed)
+        except Exception as e:
+            print(f"Failed to sweep stale uploads: {e}")
+        await asyncio.sleep(UPLOAD_SWEEP_INTERVAL)
+
+def write_upload_chunk(part_file, data: bytes) -> None:
+    part_file.write(data)
+
+@app.post("/uploads")
+async def create_upload(payload: dict, current_user: dict = Depends(get_current_user)):
+    """Start a resumable attachment upload of a declared size"""
+    user_id = current_user.get("sub")
+    if not user_id:
+        raise HTTPException(status_code=403, detail="Not authenticated")
+
+    try:
+        size = int(payload.get("size"))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="size is required")
+    if size <= 0:
+        raise HTTPException(status_code=400, detail="size must be positive")
+    if size > MAX_ATTACHMENT_BYTES:
+        raise HTTPException(status_code=413, detail="Attachment too large")
+
+    upload_id = str(uuid.uuid4())
+    session = {
+        "owner": user_id,
+        "size": size,
+        "offset": 0,
+        "filename": (payload.get("filename") or "").strip(),
+        "content_type": (payload.get("content_type") or "application/octet-stream").strip(),
+    }
+    open(upload_part_path(upload_id), "wb").close()
+    upload_key = get_upload_key(upload_id)
+    redis_client.hset(upload_key, mapping=session)
+    redis_client.expire(upload_key, UPLOAD_SESSION_TTL)
+
+    return {"upload_id": upload_id, "offset": 0, "size": size}
+
+@app.get("/uploads/{upload_id}")
+async def get_upload(upload_id: str, current_user: dict = Depends(get_current_user)):
+    """Report how many bytes of an upload have been received, for resuming"""
+    session = get_upload_session(upload_id, current_user.get("sub"))
+    return {
+        "upload_id": upload_id,
+        "offset": int(session["offset"]),
+        "size": int(session["size"]),
+    }
+
+@app.patch("/uploads/{upload_id}")
+async def append_upload_chunk(
+    upload_id: str,
+    request: Request,
+    current_user: dict = Depends(get_current_user)
+):
+    """Append the request body at Upload-Offset; finalizes once all bytes arrive"""
+    session = get_upload_session(upload_id, current_user.get("sub"))
+    size = int(session["size"])
+    offset = int(session["offset"])
+
+    try:
+        client_offset = int(request.headers.get("Upload-Offset", ""))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Upload-Offset header is required")
+    if client_offset != offset:
+        raise HTTPException(
+            status_code=409,
+            detail="Upload offset mismatch",
+            headers={"Upload-Offset": str(offset)},
+        )
+
+    part_path = upload_part_path(upload_id)
+    if not os.path.exists(part_path):
+        raise HTTPException(status_code=404, detail="Upload not found")
+
+    # File I/O runs off the event loop, in STREAM_CHUNK_BYTES writes
+    with open(part_path, "r+b") as part_file:
+        part_file.seek(offset)
+        part_file.truncate()
+        buffered = bytearray()
+        async for chunk in request.stream():
+            if offset + len(buffered) + len(chunk) > size:
+                raise HTTPException(status_code=413, detail="Chunk exceeds declared size")
+            buffered += chunk
+            if len(buffered) >= STREAM_CHUNK_BYTES:
+                await asyncio.to_thread(write_upload_chunk, part_file, bytes(buffered))
+                offset += len(buffered)
+                buffered.clear()
+        if buffered:
+            await asyncio.to_thread(write_upload_chunk, part_file, bytes(buffered))
+            offset += len(buffered)
+
+    upload_key = get_upload_key(upload_id)
+    if offset < size:
+        redis_client.hset(upload_key, "offset", offset)
+        redis_client.expire(upload_key, UPLOAD_SESSION_TTL)
+        return {"upload_id": upload_id, "offset": offset, "size": size}
+
+    attachment_id = await asyncio.to_thread(hash_file, part_path)
+    await asyncio.to_thread(attachment_store.put_file, attachment_id, part_path, "blob")
+    attachment_key = get_attachment_key(attachment_id)
+    if not redis_client.exists(attachment_key):
+        redis_client.hset(
+            attachment_key,
+            mapping={
+                "size": size,
+                "content_type": session.get("content_type") or "application/octet-stream",
+                "filename": session.get("filename", ""),
+                "uploaded_by": session["owner"],
+            },
+        )
+    # Identical files share a blob, so every uploader keeps access to it
+    redis_client.sadd(get_attachment_uploaders_key(attachment_id), session["owner"])
+    redis_client.delete(upload_key)
+
+    return {
+        "upload_id": upload_id,
+        "offset": offset,
+        "size": size,
+        "attachment_id": attachment_id,
+    }
+
+def parse_byte_range(range_header: Optional[str], size: int) -> Optional[tuple]:
+    """Parse a single `bytes=start-end` range; returns inclusive bounds"""
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+    spec = range_header[len("bytes="):].split(",")[0].strip()
+    start_text, _, end_text = spec.partition("-")
+    try:
+        if start_text:
+            start = int(start_text)
+            end = int(end_text) if end_text else size - 1
+        else:
+            length = int(end_text)
+            start = max(size - length, 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return start, min(end, size - 1)
+
+def iter_file_range(path: str, start: int, end: int):
+    with open(path, "rb") as handle:
+        handle.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = handle.read(min(STREAM_CHUNK_BYTES, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def can_view_attachment(attachment_id: str, user_id: Optional[str]) -> bool:
+    """The uploader, or anyone who can see a room with a message referencing it"""
+    if not user_id:
+        return False
+    uploaded_by = redis_client.hget(get_attachment_key(attachment_id), "uploaded_by")
+    if uploaded_by and uploaded_by.decode() == user_id:
+        return True
+    if redis_client.sismember(get_attachment_uploaders_key(attachment_id), user_id):
+        return True
+    room_ids = redis_client.smembers(get_attachment_rooms_key(attachment_id))
+    return any(check_room_access(room_id.decode(), user_id) for room_id in room_ids)
+
+@app.get("/attachments/{attachment_id}")
+async def get_attachment(
+    attachment_id: str,
+    request: Request,
+    current_user: dict = Depends(get_current_user)
+):
+    """Serve an uploaded attachment, honoring Range requests"""
+    if not is_valid_hash(attachment_id) or not attachment_store.exists(attachment_id, "blob"):
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    if not can_view_attachment(attachment_id, current_user.get("sub")):
+        raise HTTPException(status_code=403, detail="Access denied")
+
+    path = attachment_store.path_for(attachment_id, "blob")
+    size = os.path.getsize(path)
+    content_type = (
+        redis_client.hget(get_attachment_key(attachment_id), "content_type")
+        or b"application/octet-stream"
+    ).decode()
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, max-age=31536000, immutable",
+        "ETag": f'"{attachment_id}"',
+    }
+
+    byte_range = parse_byte_range(request.headers.get("Range"), size)
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(
+            iter_file_range(path, 0, size - 1), media_type=content_type, headers=headers
+        )
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        iter_file_range(path, start, end),
+        status_code=206,
+        media_type=content_type,
+        headers=headers,
     )
-    return {"status": "message deleted"}
 
 @app.get("/rooms/{room_id}/members")
 async def get_room_members(
     room_id: str,
+    request: Request,
+    response: Response,
     current_user: dict = Depends(get_current_user)
 ):
     """Return list of room members with basic profile details"""
@@ -1073,11 +2365,20 @@ async def get_room_members(
     if not user_id or not check_room_access(room_id, user_id):
         raise HTTPException(status_code=403, detail="Access denied")
 
-    member_ids = redis_client.smembers(get_users_key(room_id))
-    members = []
-    for member in member_ids:
-        user_uuid = member.decode()
-        members.append(get_profile_summary(user_uuid))
+    # Member entries embed profiles, so the tag covers the membership and
+    # each member's own profile, not every profile edit on the server
+    member_ids = sorted(repo.rooms.member_ids(room_id))
+    not_modified = check_not_modified(
+        request, response, get_users_key(room_id), *(get_user_key(member_id) for member_id in member_ids)
+    )
+    if not_modified:
+        return not_modified
+
+    profiles = repo.users.get_many(member_ids)
+    members = [
+        build_profile_summary(user_uuid, profile_data)
+        for user_uuid, profile_data in profiles.items()
+    ]
 
     return {"members": members}
 
@@ -1085,12 +2386,11 @@ async def get_room_members(
 async def invite_user(room_id: str, user_id: str, current_user: dict = Depends(get_current_user)):
     """Invite user to private room"""
     # In real implementation, add owner check here
-    redis_client.sadd(get_users_key(room_id), user_id)
-    redis_client.sadd(get_user_rooms_key(user_id), room_id)
+    add_room_member(room_id, user_id)
 
     # Add notification for invited user
-    room_data = redis_client.hgetall(get_room_key(room_id))
-    room_name = room_data.get(b"name", b"").decode() if room_data else room_id
+    room_data = repo.rooms.get(room_id)
+    room_name = room_data.get("name", "") if room_data else room_id
     inviter = current_user.get("sub")
     if inviter:
         notification = add_notification(
@@ -1122,12 +2422,17 @@ async def remove_room_member(
     if not requester_id:
         raise HTTPException(status_code=403, detail="Not authenticated")
 
-    if not redis_client.sismember(get_admins_key(room_id), requester_id):
+    removed = room_scripts.remove_member(
+        keys=[
+            get_admins_key(room_id),
+            get_users_key(room_id),
+            get_user_rooms_key(member_id),
+            get_user_activity_key(member_id),
+        ],
+        args=[requester_id, member_id, room_id],
+    )
+    if not removed:
         raise HTTPException(status_code=403, detail="Only admins can remove members")
-
-    redis_client.srem(get_users_key(room_id), member_id)
-    redis_client.srem(get_user_rooms_key(member_id), room_id)
-    redis_client.srem(get_admins_key(room_id), member_id)
     return {"status": "member removed"}
 
 @app.post("/rooms/{room_id}/admins/{member_id}")
@@ -1140,13 +2445,14 @@ async def promote_room_admin(
     if not requester_id:
         raise HTTPException(status_code=403, detail="Not authenticated")
 
-    if not redis_client.sismember(get_admins_key(room_id), requester_id):
+    promoted = room_scripts.promote_admin(
+        keys=[get_admins_key(room_id), get_users_key(room_id)],
+        args=[requester_id, member_id],
+    )
+    if promoted == 0:
         raise HTTPException(status_code=403, detail="Only admins can update admins")
-
-    if not redis_client.sismember(get_users_key(room_id), member_id):
+    if promoted == -1:
         raise HTTPException(status_code=400, detail="User is not in the room")
-
-    redis_client.sadd(get_admins_key(room_id), member_id)
     return {"status": "admin added"}
 
 @app.delete("/rooms/{room_id}/admins/{member_id}")
@@ -1159,30 +2465,33 @@ async def demote_room_admin(
     if not requester_id:
         raise HTTPException(status_code=403, detail="Not authenticated")
 
-    if not redis_client.sismember(get_admins_key(room_id), requester_id):
-        raise HTTPException(status_code=403, detail="Only admins can update admins")
-
     if member_id == requester_id:
         raise HTTPException(status_code=400, detail="Cannot demote yourself")
 
-    redis_client.srem(get_admins_key(room_id), member_id)
+    demoted = room_scripts.demote_admin(
+        keys=[get_admins_key(room_id)],
+        args=[requester_id, member_id],
+    )
+    if not demoted:
+        raise HTTPException(status_code=403, detail="Only admins can update admins")
     return {"status": "admin removed"}
 
 @app.get("/notifications")
-async def get_notifications(current_user: dict = Depends(get_current_user)):
+async def get_notifications(
+    request: Request,
+    response: Response,
+    current_user: dict = Depends(get_current_user)
+):
     """Return notifications for the current user"""
     user_id = current_user.get("sub")
     if not user_id:
         raise HTTPException(status_code=403, detail="Not authenticated")
 
-    notifications_data = redis_client.hgetall(get_notifications_key(user_id))
-    notifications = []
-    for notification_id, payload in notifications_data.items():
-        try:
-            notification = json.loads(payload.decode())
-            notifications.append(notification)
-        except json.JSONDecodeError:
-            continue
+    not_modified = check_not_modified(request, response, get_notifications_key(user_id))
+    if not_modified:
+        return not_modified
+
+    notifications = repo.notifications.list(user_id)
 
     # Sort newest first
     notifications.sort(key=lambda n: n.get("timestamp", ""), reverse=True)
@@ -1198,15 +2507,223 @@ async def mark_notification_read(
     if not user_id:
         raise HTTPException(status_code=403, detail="Not authenticated")
 
-    redis_client.hdel(get_notifications_key(user_id), notification_id)
+    with repo.batch():
+        repo.notifications.remove(user_id, notification_id)
+        bump_versions(get_notifications_key(user_id))
     return {"status": "notification dismissed"}
 
 
+def stream_position(event_id: str) -> tuple:
+    """Sortable form of a Redis stream id ("<ms>-<seq>")"""
+    ms, _, seq = event_id.partition("-")
+    try:
+        return int(ms), int(seq or 0)
+    except ValueError:
+        return 0, 0
+
+@app.get("/rooms/{room_id}/stream")
+async def stream_room(
+    room_id: str,
+    request: Request,
+    access_token: Optional[str] = None,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security),
+):
+    """Server-Sent Events feed of a room's message events for read-only viewers.
+
+    Public rooms need no token; private rooms take a bearer token in the
+    Authorization header or, for EventSource clients, ?access_token=.
+    """
+    if manager.draining:
+        raise HTTPException(status_code=503, detail="Server is restarting")
+
+    token = credentials.credentials if credentials else access_token
+    user_id = None
+    if token:
+        payload = await keycloak.verify_token(token)
+        user_id = payload.get("sub")
+
+    with repo.batch():
+        exists = repo.rooms.exists(room_id)
+        is_public = repo.rooms.is_public(room_id)
+        is_member = repo.rooms.is_member(room_id, user_id or "")
+    if not exists.value:
+        raise HTTPException(status_code=404, detail="Room not found")
+    if not is_public.value and not (user_id and is_member.value):
+        raise HTTPException(status_code=403, detail="Access denied")
+
+    # Register before reading the backlog so nothing published in between is lost
+    viewer = manager.add_viewer(room_id)
+    last_event_id = request.headers.get("Last-Event-ID") or request.query_params.get("last_event_id")
+    replay = []
+    if last_event_id:
+        try:
+            replay = repo.messages.events_after(room_id, last_event_id, SSE_REPLAY_LENGTH)
+        except redis.exceptions.ResponseError:
+            replay = []
+
+    async def events():
+        try:
+            yield f"retry: 3000\n: connected to {room_id}\n\n"
+            replayed_to = stream_position(last_event_id) if last_event_id else (0, 0)
+            for event_id, event, data in replay:
+                replayed_to = stream_position(event_id)
+                yield format_sse(data, event=event, event_id=event_id)
+
+            while not (viewer.closed and viewer.queue.empty()):
+                if await request.is_disconnected():
+                    break
+                try:
+                    item = await asyncio.wait_for(viewer.queue.get(), SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if item is None:
+                    break
+                event_id, frame = item
+                # Skip live events already sent as part of the replay
+                if event_id and stream_position(event_id) <= replayed_to:
+                    continue
+                yield frame
+        finally:
+            manager.remove_viewer(viewer)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            # Tell nginx not to buffer the stream
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness probe; fails while draining so no new traffic is routed here"""
+    if manager.draining:
+        return ORJSONResponse({"status": "draining"}, status_code=503)
+    return {"status": "ready"}
+
+def require_admin(request: Request) -> None:
+    token = request.headers.get("X-Admin-Token", "")
+    if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+@app.post("/admin/drain")
+async def admin_drain(request: Request):
+    """Start draining WebSocket connections ahead of a restart"""
+    require_admin(request)
+    connections = manager.connection_count()
+    start_drain()
+    return {"status": "draining", "connections": connections, "window": WS_DRAIN_WINDOW}
+
+@app.get("/metrics")
+async def get_metrics(request: Request):
+    """In-process counters and latency timers (X-Admin-Token required)"""
+    require_admin(request)
+    return metrics.snapshot()
+
+async def ws_send_message(connection: Connection, frame: Dict[str, Any]) -> Dict[str, Any]:
+    user_id = connection.user_id
+    message = frame.get("message")
+    if not isinstance(message, dict):
+        message = {
+            key: frame[key]
+            for key in ("content", "content_uuid", "attachments", "mentions", "reply_to")
+            if key in frame
+        }
+    sent = await send_room_message(frame.get("roomId") or "", message, user_id)
+    return {"message_id": get_message_id(sent), "timestamp": sent["timestamp"]}
+
+async def ws_edit_message(connection: Connection, frame: Dict[str, Any]) -> Dict[str, Any]:
+    user_id = connection.user_id
+    event = await edit_message(
+        frame.get("roomId") or "", frame.get("message_id") or "", frame.get("content"), user_id
+    )
+    return {"message_id": event["message_id"], "edited_at": event["edited_at"]}
+
+async def ws_delete_message(connection: Connection, frame: Dict[str, Any]) -> Dict[str, Any]:
+    user_id = connection.user_id
+    event = await delete_message(frame.get("roomId") or "", frame.get("message_id") or "", user_id)
+    return {"message_id": event["message_id"]}
+
+async def ws_typing(connection: Connection, frame: Dict[str, Any]) -> Dict[str, Any]:
+    user_id = connection.user_id
+    room_id = frame.get("roomId") or ""
+    typing = bool(frame.get("typing", True))
+    # Rate-limit before touching Redis; keystroke-rate repeats are dropped here
+    if not manager.typing_allowed(room_id, user_id, typing):
+        return {"limited": True}
+    if not repo.rooms.is_member(room_id, user_id):
+        raise HTTPException(status_code=403, detail="Access denied")
+    manager.typing(room_id, user_id, typing)
+    return {}
+
+async def ws_read(connection: Connection, frame: Dict[str, Any]) -> Dict[str, Any]:
+    user_id = connection.user_id
+    room_id = frame.get("roomId") or ""
+    if not repo.rooms.is_member(room_id, user_id):
+        raise HTTPException(status_code=403, detail="Access denied")
+    return mark_room_read(room_id, user_id, frame.get("message_id"))
+
+def frame_room_ids(frame: Dict[str, Any]) -> List[str]:
+    room_ids = frame.get("roomIds")
+    if not isinstance(room_ids, list):
+        room_ids = [frame.get("roomId")]
+    return [room_id for room_id in room_ids if isinstance(room_id, str) and room_id]
+
+async def ws_subscribe(connection: Connection, frame: Dict[str, Any]) -> Dict[str, Any]:
+    user_id = connection.user_id
+    room_ids = frame_room_ids(frame)
+    with repo.batch():
+        membership = {room_id: repo.rooms.is_member(room_id, user_id) for room_id in room_ids}
+    allowed = [room_id for room_id, is_member in membership.items() if is_member.value]
+    subscribed = manager.subscribe(connection, allowed)
+    return {
+        # null while the socket still gets full events for every room
+        "subscribed": sorted(subscribed) if subscribed is not None else None,
+        "denied": [room_id for room_id in room_ids if room_id not in allowed],
+    }
+
+async def ws_unsubscribe(connection: Connection, frame: Dict[str, Any]) -> Dict[str, Any]:
+    subscribed = manager.unsubscribe(connection, frame_room_ids(frame))
+    return {"subscribed": sorted(subscribed) if subscribed is not None else None}
+
+# Inbound frame types; each runs as the socket's authenticated user
+WS_HANDLERS = {
+    "send_message": ws_send_message,
+    "edit": ws_edit_message,
+    "delete": ws_delete_message,
+    "typing": ws_typing,
+    "read": ws_read,
+    "subscribe": ws_subscribe,
+    "unsubscribe": ws_unsubscribe,
+}
+
+async def handle_ws_frame(connection: Connection, frame: Dict[str, Any]) -> Dict[str, Any]:
+    """Run one inbound frame and build its ack, echoing the client's correlation id"""
+    ack = {"type": "ack", "id": frame.get("id"), "frame": frame.get("type")}
+    handler = WS_HANDLERS.get(frame.get("type"))
+    if handler is None:
+        return {**ack, "ok": False, "status": 400, "detail": "Unknown frame type"}
+    try:
+        result = await handler(connection, frame)
+    except HTTPException as exc:
+        return {**ack, "ok": False, "status": exc.status_code, "detail": exc.detail}
+    except Exception as exc:
+        print(f"WebSocket frame {frame.get('type')} from {connection.user_id} failed: {exc}")
+        return {**ack, "ok": False, "status": 500, "detail": "Internal error"}
+    return {**ack, "ok": True, "result": result}
+
 @app.websocket("/ws") 
 async def websocket_endpoint(websocket: WebSocket):
     print("WebSocket connection established")
     client_id = None
 
+    if manager.draining:
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        return
+
     # First send accept before any other messages
     await websocket.accept()
     
@@ -1218,31 +2735,60 @@ async def websocket_endpoint(websocket: WebSocket):
         
     payload = await keycloak.verify_token(data["token"])
     client_id = payload.get("sub")
-        
-    await manager.connect(websocket, client_id)
+    # Clients may ask for binary MessagePack frames; the reply is still JSON
+    codec = negotiate(data.get("encodings") or data.get("encoding"))
+
+    connection = await manager.connect(websocket, client_id, codec)
+    if connection is None:
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        return
     await websocket.send_json({
         "type": "auth-success", 
-        "message": "Authentication successful"
+        "message": "Authentication successful",
+        "encoding": codec.name,
+        "heartbeat_interval": manager.heartbeat_interval,
     })
 
     while True:
         try:
-            data = await websocket.receive_json()
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            # Any inbound frame, including pong, proves the socket is alive
+            connection.touch()
+            try:
+                data = decode_frame(message)
+            except Exception:
+                data = None
+            if not isinstance(data, dict):
+                await manager.send(
+                    connection,
+                    {"type": "ack", "id": None, "ok": False, "status": 400, "detail": "Malformed frame"},
+                )
+                continue
+            if data.get("type") == "pong":
+                continue
             if data.get("type") == "disconnect":
-                manager.disconnect(client_id)
-                await websocket.close()
+                await manager.close(connection)
                 return
+            await manager.send(connection, await handle_ws_frame(connection, data))
         except WebSocketDisconnect:
-            manager.disconnect(client_id)
+            manager.disconnect(connection)
+            return
+        except RuntimeError:
+            # Socket was closed by the server (reaped or evicted)
+            manager.disconnect(connection)
             return
 
 if __name__ == "__main__": 
     import uvicorn
-    uvicorn.run("users_api:app", host="0.0.0.0", port=8000, reload=True)
-    async def send_to_user(self, user_id: str, payload: Dict[str, Any]):
-        websocket = self.client_connections.get(user_id)
-        if websocket and websocket.client_state == WebSocketState.CONNECTED:
-            try:
-                await websocket.send_json(payload)
-            except WebSocketDisconnect:
-                self.disconnect(user_id)
+    from ws_deflate import DeflateWebSocketProtocol
+    uvicorn.run(
+        "users_api:app",
+        host="0.0.0.0",
+        port=8000,
+        reload=True,
+        ws=DeflateWebSocketProtocol,
+        ws_per_message_deflate=os.getenv("WS_PER_MESSAGE_DEFLATE", "1") == "1",
+    )
+
@@ -0,0 +1,85 @@
+"""Write-behind buffer for bursts of message writes.
+
+Each post_message queues its Redis writes here instead of sending its own
+pipeline. The buffer collects writes for a few milliseconds (or until it
+holds max_batch of them) and runs them all in one pipeline, in arrival
+order, so messages within a room keep their order. Callers still wait for
+their flush, so a message is stored before its sender gets a response.
+A write that raises, or whose commands fail, rejects only its own caller.
+"""
+import asyncio
+from typing import Any, Callable, List, Optional, Tuple
+
+from metrics import Metrics
+from repository import Repository
+
+
+class WriteBehindBuffer:
+    def __init__(self, repo: Repository, metrics: Metrics, window: float = 0.0, max_batch: int = 100):
+        self.repo = repo
+        self.metrics = metrics
+        # Seconds to gather writes before a flush; 0 writes each call immediately
+        self.window = window
+        self.max_batch = max(max_batch, 1)
+        self._pending: List[Tuple[Callable[[], Any], asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def submit(self, write: Callable[[], Any]) -> Any:
+        """Queue write (a function making repository calls) and return its result once flushed"""
+        if self.window <= 0:
+            with self.repo.batch():
+                result = write()
+            return result
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((write, future))
+        if len(self._pending) >= self.max_batch:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+        return await future
+
+    def flush(self) -> None:
+        """Run every queued write in one pipeline and hand each caller its result"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        self.metrics.observe("write_behind.batch_size", len(pending))
+        # (future, result, error, checked Deferreds) per write, so a failing
+        # write only rejects its own caller
+        outcomes = []
+        try:
+            with self.repo.batch(raise_errors=False) as batch:
+                for write, future in pending:
+                    checkpoint = batch.checkpoint()
+                    try:
+                        result = write()
+                    except Exception as e:
+                        # Nothing this write queued is sent
+                        batch.rollback(checkpoint)
+                        outcomes.append((future, None, e, []))
+                        continue
+                    outcomes.append((future, result, None, batch.checked_since(checkpoint)))
+        except Exception as e:
+            # The pipeline itself failed, so no write in it is known to be stored
+            self.metrics.incr("write_behind.errors")
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, result, error, checked in outcomes:
+            if error is None:
+                error = next((deferred.error for deferred in checked if deferred.error is not None), None)
+            if error is not None:
+                self.metrics.incr("write_behind.errors")
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
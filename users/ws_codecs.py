@@ -0,0 +1,78 @@
+"""Wire encodings for /ws frames.
+
+A connection picks its codec in the auth handshake; JSON text frames are the
+default. Broadcasts encode each payload once per codec in use rather than
+once per recipient, so adding binary clients costs at most one extra encode.
+"""
+from typing import Any, Dict, Hashable, Iterable, Optional, Union
+
+import msgpack
+import orjson
+
+
+class Codec:
+    name = ""
+    binary = False
+
+    def encode(self, payload: Any) -> Union[str, bytes]:
+        raise NotImplementedError
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    name = "json"
+    binary = False
+
+    def encode(self, payload: Any) -> str:
+        return orjson.dumps(payload).decode()
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+
+
+class MessagePackCodec(Codec):
+    name = "msgpack"
+    binary = True
+
+    def encode(self, payload: Any) -> bytes:
+        return msgpack.packb(payload, use_bin_type=True)
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        return msgpack.unpackb(data, raw=False)
+
+
+CODECS: Dict[str, Codec] = {codec.name: codec for codec in (JsonCodec(), MessagePackCodec())}
+DEFAULT_CODEC = CODECS["json"]
+
+
+def negotiate(requested: Optional[Union[str, Iterable[str]]]) -> Codec:
+    """First supported encoding the client asked for, falling back to JSON."""
+    if isinstance(requested, str):
+        requested = [requested]
+    for name in requested or []:
+        codec = CODECS.get(str(name).lower())
+        if codec is not None:
+            return codec
+    return DEFAULT_CODEC
+
+
+def decode_frame(message: Dict[str, Any]) -> Any:
+    """Decode an ASGI websocket.receive message: binary frames are MessagePack, text is JSON."""
+    if message.get("bytes") is not None:
+        return CODECS["msgpack"].decode(message["bytes"])
+    return DEFAULT_CODEC.decode(message.get("text") or "")
+
+
+class EncodedFrames:
+    """Per-broadcast cache so each payload is encoded at most once per codec."""
+
+    def __init__(self):
+        self._frames: Dict[tuple, Union[str, bytes]] = {}
+
+    def get(self, key: Hashable, payload: Any, codec: Codec) -> Union[str, bytes]:
+        cache_key = (key, codec.name)
+        if cache_key not in self._frames:
+            self._frames[cache_key] = codec.encode(payload)
+        return self._frames[cache_key]
@@ -0,0 +1,61 @@
+"""permessage-deflate with tunable settings for the uvicorn websockets server.
+
+uvicorn only exposes an on/off switch for compression. This protocol keeps
+that switch and adds zlib level, memory level and window size, plus a
+minimum message size below which frames are sent uncompressed (RFC 7692
+allows compression to be skipped per message).
+"""
+import os
+from typing import Any, List, Optional, Sequence, Tuple
+
+from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+from websockets.extensions.base import Extension
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+from websockets.frames import Frame, Opcode
+
+WS_DEFLATE_LEVEL = int(os.getenv("WS_DEFLATE_LEVEL", "6"))
+WS_DEFLATE_MEM_LEVEL = int(os.getenv("WS_DEFLATE_MEM_LEVEL", "8"))
+WS_DEFLATE_WINDOW_BITS = int(os.getenv("WS_DEFLATE_WINDOW_BITS", "15"))
+WS_DEFLATE_MIN_BYTES = int(os.getenv("WS_DEFLATE_MIN_BYTES", "256"))
+
+
+class ThresholdDeflate(Extension):
+    """Wraps a negotiated PerMessageDeflate and skips it for small single-frame messages."""
+
+    def __init__(self, extension: Extension, min_size: int):
+        self.extension = extension
+        self.min_size = min_size
+        self.name = extension.name
+
+    def decode(self, frame: Frame, *, max_size: Optional[int] = None) -> Frame:
+        return self.extension.decode(frame, max_size=max_size)
+
+    def encode(self, frame: Frame) -> Frame:
+        if frame.fin and frame.opcode in (Opcode.TEXT, Opcode.BINARY) and len(frame.data) < self.min_size:
+            return frame
+        return self.extension.encode(frame)
+
+
+class ThresholdDeflateFactory(ServerPerMessageDeflateFactory):
+    def __init__(self, min_size: int, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.min_size = min_size
+
+    def process_request_params(
+        self, params: Sequence[Tuple[str, Optional[str]]], accepted_extensions: Sequence[Extension]
+    ) -> Tuple[List[Tuple[str, Optional[str]]], Extension]:
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, ThresholdDeflate(extension, self.min_size)
+
+
+class DeflateWebSocketProtocol(WebSocketProtocol):
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        if self.config.ws_per_message_deflate:
+            self.available_extensions = [
+                ThresholdDeflateFactory(
+                    min_size=WS_DEFLATE_MIN_BYTES,
+                    server_max_window_bits=WS_DEFLATE_WINDOW_BITS,
+                    compress_settings={"level": WS_DEFLATE_LEVEL, "memLevel": WS_DEFLATE_MEM_LEVEL},
+                )
+            ]
@@ -18,6 +18,9 @@ interface RoomProps {
 import { useNavigate, useParams } from "react-router-dom";
 import { send } from "process";
 
+// Externalized message payloads are immutable, so cache them by content hash
+const payloadCache = new Map<string, Promise<string>>();
+
 const Room: React.FC<RoomProps> = ({ roomId }) => {
   const { keycloak, tdfClient } = useAuth();
   const navigate = useNavigate();
@@ -228,11 +231,40 @@ const Room: React.FC<RoomProps> = ({ roomId }) => {
     return JSON.parse(decoder.decode(decrypted));
   };
 
+  const fetchPayload = (hash: string): Promise<string> => {
+    let cached = payloadCache.get(hash);
+    if (!cached) {
+      cached = fetch(
+        `${import.meta.env.VITE_USERS_API_URL}/rooms/${roomId}/payloads/${hash}`,
+        { headers: { Authorization: `Bearer ${keycloak?.token}` } }
+      ).then((response) => {
+        if (!response.ok) {
+          throw new Error(`Failed to fetch payload ${hash}: ${response.status}`);
+        }
+        return response.text();
+      });
+      cached.catch(() => payloadCache.delete(hash));
+      payloadCache.set(hash, cached);
+    }
+    return cached;
+  };
+
   const processMessage = async (message: any) => {
     try {
       let content;
       let encrypted = false;
 
+      if (message.content == null && message.payload?.hash) {
+        const payloadText = await fetchPayload(message.payload.hash);
+        message = {
+          ...message,
+          content:
+            message.payload.encoding === "json"
+              ? JSON.parse(payloadText)
+              : payloadText,
+        };
+      }
+
       if (typeof message.content === "string") {
         const trimmedContent = message.content.trim();
         if (trimmedContent.startsWith("TDF")) {
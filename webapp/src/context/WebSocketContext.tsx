@@ -1,4 +1,4 @@
-import React, { createContext, useContext, useEffect, useState } from 'react';
+import React, { createContext, useContext, useEffect, useRef, useState } from 'react';
 import { useAuth } from './AuthContext';
 
 interface WebSocketContextType {
@@ -17,6 +17,9 @@ export const WebSocketProvider: React.FC<{ children: React.ReactNode }> = ({ chi
   const [connectionStatus, setConnectionStatus] = useState<
     'connecting' | 'connected' | 'disconnected' | 'error'
   >('disconnected');
+  // Bumped to reopen the socket after the server asks us to reconnect
+  const [reconnectCount, setReconnectCount] = useState(0);
+  const reconnectDelay = useRef<number | null>(null);
 
   useEffect(() => {
     if (!keycloak?.authenticated) {
@@ -65,18 +68,43 @@ export const WebSocketProvider: React.FC<{ children: React.ReactNode }> = ({ chi
       console.log(`WebSocket closed: ${event.code} - ${event.reason}`);
       setWs(null);
       setConnectionStatus('disconnected');
+      const delay = reconnectDelay.current;
+      reconnectDelay.current = null;
+      if (delay !== null) {
+        setTimeout(() => setReconnectCount((count) => count + 1), delay);
+      }
     };
 
     socket.onopen = () => {
       setConnectionStatus('connected');
       handleAuth();
     };
+    // Answer server heartbeats so the connection isn't reaped as idle, and
+    // remember the server's jittered delay when it is about to restart
+    socket.addEventListener("message", (event) => {
+      if (typeof event.data !== "string") return;
+      try {
+        const frame = JSON.parse(event.data);
+        if (frame.type === "ping") {
+          socket.send(JSON.stringify({ type: "pong" }));
+        } else if (frame.type === "reconnect") {
+          reconnectDelay.current = Number(frame.delay_ms) || 0;
+        } else if (frame.type === "batch" && Array.isArray(frame.events)) {
+          // Coalesced room events: replay each one to the other listeners
+          for (const item of frame.events) {
+            socket.dispatchEvent(new MessageEvent("message", { data: JSON.stringify(item) }));
+          }
+        }
+      } catch {
+        // Not JSON; other listeners handle it
+      }
+    });
     setWs(socket);
 
     return () => {
       socket.close();
     };
-  }, [keycloak?.authenticated, keycloak?.token]);
+  }, [keycloak?.authenticated, keycloak?.token, reconnectCount]);
 
   return (
     <WebSocketContext.Provider value={{ ws, connectionStatus }}>